@@ -0,0 +1,150 @@
+import math
+import os
+
+import metricas
+from clases import PlotTemplate
+
+# Size of the text of the table of contents, in points, and of each entry in
+# inches (height of a line, width of a column)
+_TOC_FONT = 9
+_TOC_LINE = 0.2
+_TOC_COLUMN = 4.0
+_TOC_MARGIN = 0.6
+
+
+def _toc_layout(width: float, height: float) -> tuple:
+    """
+    Returns the number of lines and columns of entries that fit in a page of
+    the table of contents.
+    """
+    lines = max(1, int((height - 2 * _TOC_MARGIN - 0.4) / _TOC_LINE))
+    columns = max(1, int((width - 2 * _TOC_MARGIN) / _TOC_COLUMN))
+    return lines, columns
+
+
+def _page_paths(path: str, pages: int) -> list:
+    stem, extension = os.path.splitext(path)
+    digits = len(str(pages))
+    return [f"{stem}_{page:0{digits}d}{extension}" for page in range(1, pages + 1)]
+
+
+@metricas.timed("write_atlas")
+def write_atlas(items: dict, path: str, names: list = None, grid: tuple = (1, 1),
+                dpi: float = None, indice: bool = True) -> int:
+    """
+    Saves the plots of many items in one document: a multi-page PDF, or one
+    image per page, with a grid of plots on each page and a table of contents
+    at the start.
+
+    The pages are drawn on the same figure (see PlotTemplate) and written as
+    soon as they are complete, so the memory used does not grow with the
+    number of plots.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree, as returned by create_tree.
+    path : str
+        File to write. With the extension .pdf all the pages go to that file,
+        otherwise each page is saved as an image with the page number after
+        the name: "atlas.png" is saved as "atlas_001.png", "atlas_002.png"...
+    names : list, optional
+        Names of the items to plot, in order. By default all the items.
+    grid : tuple, optional
+        Rows and columns of plots in each page, (1, 1) by default.
+    dpi : float, optional
+        Resolution of the pages, by default the one of matplotlib (100). In a
+        PDF the curves are vectors and it only changes the size of the file
+        slightly.
+    indice : bool, optional
+        If True (the default), the first pages list the items and the page of
+        each one.
+
+    Returns
+    -------
+    int
+        Number of plots that could not be created. Their place in the page is
+        left with the error message, so the page numbers of the table of
+        contents do not change.
+    """
+    from matplotlib import pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    if names is None:
+        names = list(items)
+    filas, columnas = grid
+    per_page = filas * columnas
+    template = PlotTemplate(filas, columnas)
+    fig = template.fig
+    width, height = fig.get_size_inches()
+
+    toc_lines, toc_columns = _toc_layout(width, height)
+    per_toc_page = toc_lines * toc_columns
+    toc_pages = math.ceil(len(names) / per_toc_page) if indice else 0
+    pages = toc_pages + math.ceil(len(names) / per_page)
+
+    pdf = None
+    if os.path.splitext(path)[1].lower() == ".pdf":
+        pdf = PdfPages(path, metadata={"Title": "Curvas intensidad-tiempo"})
+        page_paths = None
+    else:
+        page_paths = _page_paths(path, pages)
+
+    def save(figure, page: int):
+        with metricas.stage("savefig"):
+            if pdf is not None:
+                pdf.savefig(figure, dpi=dpi)
+            else:
+                figure.savefig(page_paths[page - 1], dpi=dpi)
+
+    length = len(names)
+    errors = 0
+    try:
+        if toc_pages:
+            toc = plt.figure(figsize=(width, height))
+            for page in range(1, toc_pages + 1):
+                toc.clear()
+                toc.text(_TOC_MARGIN / width, 1 - _TOC_MARGIN / height,
+                         "Indice" if page == 1 else "Indice (cont.)",
+                         fontsize=14, va="top")
+                start = (page - 1) * per_toc_page
+                for i, name in enumerate(names[start:start + per_toc_page]):
+                    column, line = divmod(i, toc_lines)
+                    number = toc_pages + (start + i) // per_page + 1
+                    toc.text((_TOC_MARGIN + column * _TOC_COLUMN) / width,
+                             1 - (_TOC_MARGIN + 0.4 + line * _TOC_LINE) / height,
+                             f"{str(name)[:30]:<30} {number:>6}", fontsize=_TOC_FONT,
+                             family="monospace", va="top")
+                save(toc, page)
+            plt.close(toc)
+
+        notes = []
+        for page, start in enumerate(range(0, length, per_page), start=toc_pages + 1):
+            for note in notes:
+                note.remove()
+            notes = []
+            for j, ax in enumerate(template.axes):
+                i = start + j
+                if i >= length:
+                    ax.set_visible(False)
+                    continue
+                name = names[i]
+                try:
+                    with metricas.stage("figura", item=name):
+                        with metricas.stage("add_plot"):
+                            template.create_plot(items[name], ax)
+                    print(f"fig {i + 1}/{length} - {name} - {(i + 1)*100/length:.1f}%")
+                except Exception as e:
+                    print(e)
+                    metricas.record_error("write_atlas", name, e)
+                    errors += 1
+                    ax.set_visible(False)
+                    box = ax.get_position()
+                    notes.append(fig.text((box.x0 + box.x1) / 2, (box.y0 + box.y1) / 2,
+                                          f"{name}\n{e}", ha="center", va="center"))
+            save(fig, page)
+    finally:
+        if pdf is not None:
+            pdf.close()
+        template.close()
+    return errors
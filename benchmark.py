@@ -0,0 +1,143 @@
+"""
+Benchmark of the load -> tree -> plot pipeline over synthetic sheets.
+
+    python benchmark.py --sizes 100 1000 10000 50000 --plots 10 --output bench.json
+
+For each size a sheet is generated with sintetico.generate_sheet, and each
+stage is timed and then run again under tracemalloc to measure its peak of
+allocated memory. The plotting stages use a random sample of items, and
+report the time per plot.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+def _measure(function, memory: bool = True) -> dict:
+    """
+    Runs the function and returns its result, wall time and memory peak.
+    The memory is measured in a second run, because tracemalloc slows down
+    the code it traces.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return result, {"segundos": seconds, "pico_MB": peak}
+
+
+def run_size(filas: int, plots: int, fan_out: int, profundidad: int,
+             memory: bool, seed: int) -> dict:
+    """
+    Benchmarks every stage of the pipeline for a sheet of about `filas` rows.
+    """
+    import curvas
+    from clases import PlotTemplate, clear_curve_cache, curve_cache_info
+    from matplotlib import pyplot as plt
+    from sintetico import write_sheet
+
+    results = {}
+    clear_curve_cache()
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "unifilar.csv")
+        write_sheet(path, n_barras=max(1, round(filas / (1 + fan_out))),
+                    fan_out=fan_out, profundidad=profundidad, seed=seed)
+
+        df, results["get_data"] = _measure(
+            lambda: curvas.get_data(path, cache=False), memory)
+        results["filas"] = len(df)
+        items, results["create_tree"] = _measure(
+            lambda: curvas.create_tree(df), memory)
+        _, results["analyze_selectivity"] = _measure(
+            lambda: curvas.analyze_selectivity(items), memory)
+
+        names = random.Random(seed).sample(list(items), min(plots, len(items)))
+        template = PlotTemplate()
+
+        def add_plot():
+            for name in names:
+                template.create_plot(items[name])
+
+        def create_plot():
+            for name in names:
+                plt.close(items[name].create_plot())
+
+        def create_all_plots():
+            curvas.create_all_plots(df, items, names=names, incremental=False)
+
+        _, results["add_plot"] = _measure(add_plot, memory)
+        _, results["create_plot"] = _measure(create_plot, memory)
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+            _, results["create_all_plots"] = _measure(create_all_plots, memory)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            os.chdir(cwd)
+        template.close()
+        for stage in ("add_plot", "create_plot", "create_all_plots"):
+            results[stage]["segundos_por_grafica"] = results[stage]["segundos"] / len(names)
+    results["cache_curvas"] = curve_cache_info()
+    return results
+
+
+def print_table(results: dict):
+    stages = ["get_data", "create_tree", "analyze_selectivity",
+              "add_plot", "create_plot", "create_all_plots"]
+    print(f"{'filas':>8} " + " ".join(f"{stage:>20}" for stage in stages))
+    for size in results.values():
+        cells = []
+        for stage in stages:
+            value = size[stage].get("segundos_por_grafica", size[stage]["segundos"])
+            peak = size[stage]["pico_MB"]
+            cells.append(f"{value:9.4f}s" + (f" {peak:8.1f}MB" if peak is not None else " " * 11))
+        print(f"{size['filas']:>8} " + " ".join(f"{cell:>20}" for cell in cells))
+    print("(las etapas de graficas muestran el tiempo por grafica)")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000],
+                        help="cantidad aproximada de filas de cada hoja")
+    parser.add_argument("--plots", type=int, default=10,
+                        help="cantidad de graficas de cada etapa de graficas")
+    parser.add_argument("--fan-out", type=int, default=5)
+    parser.add_argument("--profundidad", type=int, default=6)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="no medir la memoria (cada etapa se ejecuta una sola vez)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="archivo JSON con los resultados")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        print(f"Midiendo {size} filas...", file=sys.stderr)
+        results[str(size)] = run_size(size, args.plots, args.fan_out, args.profundidad,
+                                      not args.no_memory, args.seed)
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
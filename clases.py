@@ -1,9 +1,16 @@
-from dataclasses import dataclass, field
+from __future__ import annotations
+
+import gc
+import hashlib
+import io
+import os
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass, field, fields, is_dataclass
+from functools import lru_cache
 from typing import Optional
 
-from matplotlib import pyplot as plt
-from matplotlib.colors import ListedColormap
 import numpy as np
+# matplotlib se importa al graficar, para que el resto del modulo cargue rapido
 # Se crea un estructura de arbol que representa un diagrama electrico unifilar
 # Primero se crea la clase nodo
 
@@ -37,9 +44,55 @@ def lighten_color(color, amount=-0.5):
 
 
 @dataclass
+class Curva:
+    """
+    Curva tiempo-corriente definida por puntos de quiebre, que se interpola
+    linealmente en escala log-log.
+
+    Los puntos se guardan en el orden en que se grafican. Para evaluar la
+    curva se ordenan por corriente creciente (y tiempo decreciente en los
+    tramos verticales).
+    """
+    I: np.ndarray
+    t: np.ndarray
+
+    def __post_init__(self):
+        self.I = np.asarray(self.I, dtype=float)
+        self.t = np.asarray(self.t, dtype=float)
+        order = np.lexsort((-self.t, self.I))
+        self._log_I = np.log10(self.I[order])
+        self._log_t = np.log10(self.t[order])
+
+    def trip_time(self, I: np.ndarray) -> np.ndarray:
+        """
+        Returns the time (s) of the curve for each current in I (A).
+        Currents below the curve return np.inf, currents above it return the
+        shortest time of the curve.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_I = np.log10(np.asarray(I, dtype=float))
+        return np.power(10.0, np.interp(log_I, self._log_I, self._log_t, left=np.inf))
+
+    def trip_current(self, t: np.ndarray) -> np.ndarray:
+        """
+        Returns the current (A) of the curve for each time in t (s), the
+        inverse of trip_time. Times shorter than the curve return np.inf,
+        longer times return the lowest current of the curve.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_t = np.log10(np.asarray(t, dtype=float))
+        return np.power(10.0, np.interp(log_t, self._log_t[::-1], self._log_I[::-1], left=np.inf))
+
+
+# Los nodos y dispositivos usan __slots__ (slots=True): en redes de cientos de
+# miles de elementos ahorran la memoria del __dict__ de cada instancia
+
+@dataclass(slots=True)
 class Nodo:
     name: str
     parent: Optional['Nodo'] = None
+    # (profundidad, nivel de conductores, raiz), se calcula al pedirlo
+    _cache: tuple = field(default=None, init=False, repr=False, compare=False)
 
     def add_plot(self, *args, **kwargs):
         if self.parent is None:
@@ -54,65 +107,171 @@ class Nodo:
         pass
 
     def add_child(self, child: Optional['Nodo']):
-        if hasattr(self, "children"):
-            self.children.append(child)
-            child.parent = self
-        elif hasattr(self, "child"):
-            self.child = child
-            child.parent = self
+        """
+        Conecta el hijo al nodo. Por defecto un nodo tiene un solo hijo
+        (child), Barra tiene una lista (children) y Carga no tiene hijos
+        """
+        self.child = child
+        child.set_parent(self)
+
+    def remove_child(self, child: 'Nodo'):
+        """
+        Desconecta el hijo del nodo, si es su hijo
+        """
+        if self.child is child:
+            self.child = None
+            child.set_parent(None)
+
+    def set_parent(self, parent: Optional['Nodo']):
+        """
+        Cambia el padre del nodo y borra los datos cacheados del nodo y de sus
+        descendientes
+        """
+        self.parent = parent
+        # si un nodo no tiene cache, ninguno de sus descendientes lo tiene
+        nodos = [self]
+        while nodos:
+            nodo = nodos.pop()
+            if nodo is None or nodo._cache is None:
+                continue
+            nodo._cache = None
+            nodos.extend(nodo.get_children() or [])
+
+    def _cached(self) -> tuple:
+        if self._cache is None:
+            chain = []
+            nodo = self
+            while nodo is not None and nodo._cache is None:
+                chain.append(nodo)
+                nodo = nodo.parent
+            if nodo is None:
+                nodo = chain.pop()
+                nodo._cache = (0, 0, nodo)
+            for child in reversed(chain):
+                depth, level, root = nodo._cache
+                child._cache = (depth + 1, level + isinstance(child, Conductor), root)
+                nodo = child
+        return self._cache
+
+    @property
+    def depth(self) -> int:
+        """
+        Cantidad de nodos entre el nodo y la raiz
+        """
+        return self._cached()[0]
+
+    @property
+    def conductor_level(self) -> int:
+        """
+        Cantidad de conductores entre el nodo (incluido) y la raiz
+        """
+        return self._cached()[1]
+
+    @property
+    def root(self) -> 'Nodo':
+        return self._cached()[2]
 
     def get_children(self):
-        if hasattr(self, "children"):
-            return self.children
-        elif hasattr(self, "child"):
-            return [self.child]
+        return [self.child]
+
+    def parameters(self) -> tuple:
+        """
+        Devuelve el tipo del nodo y el valor de sus campos, sin los enlaces
+        del arbol
+        """
+        values = []
+        for f in fields(self):
+            if f.name in ("parent", "child", "children") or not f.compare:
+                continue
+            value = getattr(self, f.name)
+            values.append((f.name, astuple(value) if is_dataclass(value) else value))
+        return type(self).__name__, tuple(values)
+
+    def plot_hash(self, **settings) -> str:
+        """
+        Devuelve un hash de los parametros del nodo, de todos sus ancestros y
+        de los ajustes del grafico. Como la grafica de un nodo solo depende de
+        esa cadena, el hash cambia solo si cambia la grafica.
+        """
+        sha1 = hashlib.sha1(repr(sorted(settings.items())).encode())
+        nodo = self
+        while nodo is not None:
+            sha1.update(repr(nodo.parameters()).encode())
+            nodo = nodo.parent
+        return sha1.hexdigest()
 
     def __repr__(self):
         return str(self.name)
 
     def __str__(self):
-        def print_tree(node: Nodo, text: str, level=0):
-            if node is None:
-                return ""
-            if isinstance(node, (Carga, Barra)):
-                text = text + f"    {'┃   ' * level}┣━ {node.name}\n"
-                level += 1
-            children = node.get_children()
-            if children is None:
-                return text
-            for child in children:
-                text = print_tree(child, text, level)
-            return text
-
-        parents = list()
-        child = self
-        while not isinstance(child, Red):
-            child = child.parent
-            if isinstance(child, (Carga, Barra)):
-                parents.append(child)
-        red = child
-
-        text = ""
-        tabs = len(parents)
+        output = io.StringIO()
+        self.write_tree(output)
+        return output.getvalue()
 
-        # Add parents to list
-        for tab, item in enumerate(parents):
-            text = f"    {'┃   ' *(tabs-tab-1)}┣━ {item.name}\n" + text
+    def write_tree(self, output, max_depth: int = None):
+        """
+        Escribe en output (un archivo o io.StringIO) el unifilar desde la raiz
+        hasta el nodo y todo lo que alimenta, una linea por barra/carga. Se
+        recorre sin recursion y cada linea se escribe al llegar a ella.
 
-        text = f"=={red.name}\n" + text
+        Con max_depth se escriben solo esa cantidad de niveles de barras/cargas
+        a partir del nodo (con 1, el nodo y no lo que alimenta; desde la red,
+        solo las barras/cargas conectadas a la red).
+        """
+        parents = []
+        root = self
+        while root.parent is not None:
+            root = root.parent
+            if isinstance(root, (Carga, Barra)):
+                parents.append(root)
 
-        text = print_tree(self, text, tabs)
+        output.write(f"=={root.name}\n")
+        for tab, item in enumerate(reversed(parents)):
+            output.write(f"    {'┃   ' * tab}┣━ {item.name}\n")
 
-        return text
+        tabs = len(parents)
+        stack = [(self, tabs)]
+        while stack:
+            node, level = stack.pop()
+            if node is None:
+                continue
+            if isinstance(node, (Carga, Barra)):
+                if max_depth is not None and level - tabs >= max_depth:
+                    continue
+                output.write(f"    {'┃   ' * level}┣━ {node.name}\n")
+                level += 1
+            children = node.get_children()
+            if children:
+                stack.extend((child, level) for child in reversed(children))
 
 
-@dataclass
+@dataclass(slots=True)
 class GraphicCreator():
 
     def create_plot(self, ax=None):
         if ax is None:
+            from matplotlib import pyplot as plt
             fig, ax = plt.subplots(figsize=(12, 8))
         self.add_plot(ax=ax)
+        self.plot_faults(ax)
+        self.format_plot(ax)
+        return ax.get_figure()
+
+    def plot_faults(self, ax: plt.Axes):
+        """
+        Marca las corrientes de cortocircuito maxima y minima del nodo, si se
+        calcularon (ver cortocircuito.short_circuit)
+        """
+        for I, label in ((self.I_cc, 'máx'), (self.I_cc_min, 'mín')):
+            if I > 0:
+                ax.plot([I, I], [0.001, 1e6], color='k', linestyle='-.', linewidth=1,
+                        label=f'I_cc {label}={round_to_text(round(I / 1000, 1))}kA')
+
+    def format_plot(self, ax: plt.Axes):
+        """
+        Ajusta los ejes, la grilla, la leyenda y el titulo a las curvas ya
+        graficadas en ax
+        """
         # ax.set_aspect(0.707)
         conductores = [
             line for line in ax.lines if line.get_linestyle() == '-']
@@ -131,63 +290,364 @@ class GraphicCreator():
         ax.set_ylabel('Tiempo (s)')
         ax.set_title(
             f"Curvas para {self.name}" if self.name else 'Curva Intensidad tiempo')
-        return fig
+
+
+class PlotTemplate():
+    """
+    Figura de 12x8 que se reutiliza para graficar varios nodos, en lugar de
+    crear una figura nueva para cada uno. En cada grafica se reemplazan las
+    curvas y la leyenda y se vuelven a ajustar los ejes y el titulo.
+
+    Con filas y columnas la figura es una grilla de graficas de 12x8, para
+    poner varios nodos en una misma pagina (ver atlas.write_atlas).
+
+    La figura no se registra en pyplot, asi plt.show() o plt.close('all') en
+    el menu no la muestran ni la cierran.
+    """
+
+    def __init__(self, filas: int = 1, columnas: int = 1):
+        from matplotlib.figure import Figure
+        self.fig = Figure(figsize=(12 * columnas, 8 * filas))
+        axes = self.fig.subplots(filas, columnas, squeeze=False)
+        self.axes = list(axes.flat)
+        self.ax = self.axes[0]
+
+    def create_plot(self, nodo: GraphicCreator, ax: plt.Axes = None):
+        if ax is None:
+            ax = self.ax
+        ax.set_visible(True)
+        for line in list(ax.lines):
+            line.remove()
+        if ax.get_legend() is not None:
+            ax.get_legend().remove()
+        # los limites se vuelven a calcular con las curvas nuevas
+        ax.relim()
+        ax.set_autoscale_on(True)
+        nodo.add_plot(ax=ax)
+        nodo.plot_faults(ax)
+        nodo.format_plot(ax)
+        return self.fig
+
+    def close(self):
+        self.fig.clear()
 
 
 # Ahora se crean las clases que heredan de la clase nodo, y representan las partes de un sistema electrico: Red, Barras, Protecciones y Cargas
 
-@dataclass
-class Red(Nodo):
+class _Hijos:
+    """
+    Metodos de los nodos con una lista de hijos (children), Red y Barra. Va
+    antes de Nodo en las bases para reemplazar los de un solo hijo
+    """
+    __slots__ = ()
+
+    def add_child(self, child: Optional['Nodo']):
+        self.children.append(child)
+        child.set_parent(self)
+
+    def remove_child(self, child: 'Nodo'):
+        # por identidad: == compara los campos de todo el subarbol
+        for i, nodo in enumerate(self.children):
+            if nodo is child:
+                del self.children[i]
+                child.set_parent(None)
+                return
+
+    def get_children(self):
+        return self.children
+
+
+@dataclass(slots=True)
+class Red(_Hijos, Nodo):
     name: str = field(default="red")
     parent: Nodo = field(default=None)
-    child: Nodo = None
+    # todas las protecciones alimentadas desde la red
+    children: list = field(default_factory=list)
 
     def add_plot(self, *args, **kwargs):
         return
 
 
-@dataclass
+def trip_times(curvas: list, I: np.ndarray) -> np.ndarray:
+    """
+    Evaluates many curves at once with the same interpolation as
+    Curva.trip_time.
+
+    Parameters
+    ----------
+    curvas : list of Curva
+        The n curves to evaluate.
+    I : np.ndarray
+        Currents (A), either a shared grid of shape (m,) or one row per curve
+        of shape (n, m).
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n, m) with the time of each curve at each current.
+    """
+    n = len(curvas)
+    I = np.broadcast_to(np.asarray(I, dtype=float), (n, np.shape(I)[-1]))
+    if n == 0:
+        return np.empty(I.shape)
+    X, Y = log_points(curvas)
+    return trip_times_log(X, Y, I)
+
+
+def log_points(curvas: list) -> tuple:
+    """
+    Returns the points of the curves in log10 as the arrays X and Y of
+    trip_times_log, of shape (n, k). Each curve is padded repeating its last
+    point, so all of them have the k points of the longest one.
+    """
+    n = len(curvas)
+    k = max((len(curva._log_I) for curva in curvas), default=1)
+    X = np.empty((n, k))
+    Y = np.empty((n, k))
+    for row, curva in enumerate(curvas):
+        X[row, :len(curva._log_I)] = curva._log_I
+        X[row, len(curva._log_I):] = curva._log_I[-1]
+        Y[row, :len(curva._log_t)] = curva._log_t
+        Y[row, len(curva._log_t):] = curva._log_t[-1]
+    return X, Y
+
+
+def trip_times_log(X: np.ndarray, Y: np.ndarray, I: np.ndarray) -> np.ndarray:
+    """
+    Evaluates n curves given by their points in log10, sorted like the ones
+    of Curva, without creating a Curva for each one (see trip_times).
+
+    Parameters
+    ----------
+    X, Y : np.ndarray
+        log10 of the currents and of the times of the points, of shape (n, k).
+        The curves with less points repeat their last point.
+    I : np.ndarray
+        Currents (A), of shape (m,) or (n, m).
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n, m) with the time of each curve at each current.
+    """
+    n, k = X.shape
+    I = np.broadcast_to(np.asarray(I, dtype=float), (n, np.shape(I)[-1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.log10(I)
+    left = ~(q >= X[:, :1])
+    right = q >= X[:, -1:]
+    # shift every row to its own range, so one searchsorted finds all segments
+    offset = np.arange(n)[:, None] * (np.ptp(X) + 1) - X[:, :1]
+    j = np.searchsorted((X + offset).ravel(),
+                        (np.clip(q, X[:, :1], X[:, -1:]) + offset).ravel(), side='right')
+    j = np.clip(j.reshape(n, -1) - np.arange(n)[:, None] * k, 1, k - 1)
+    rows = np.arange(n)[:, None]
+    x0, x1 = X[rows, j - 1], X[rows, j]
+    y0, y1 = Y[rows, j - 1], Y[rows, j]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = y0 + (y1 - y0) * (q - x0) / (x1 - x0)
+    y = np.where(right, Y[:, -1:], y)
+    y = np.where(left, np.inf, y)
+    y = np.where(np.isnan(q), np.nan, y)
+    return np.power(10.0, y)
+
+
+class CatalogoFusibles:
+    """
+    Catalogo de curvas de fusion leido de un archivo CSV con las columnas
+    fabricante, familia, I_f, t, I (un punto de la curva por fila).
+
+    Las curvas de cada fabricante y familia se guardan en dos matrices de
+    NumPy, una fila por calibre, ordenadas por I_f.
+    """
+
+    def __init__(self, path: str = None):
+        self.familias = {}
+        self._sha1 = hashlib.sha1()
+        self.version = self._sha1.hexdigest()
+        if path is not None:
+            self.load(path)
+
+    def load(self, path: str):
+        """
+        Agrega al catalogo las curvas del archivo. Una familia que ya estaba
+        cargada se reemplaza.
+        """
+        with open(path, "rb") as f:
+            self._sha1.update(f.read())
+        datos = np.genfromtxt(path, delimiter=',', names=True, dtype=None,
+                              encoding='utf-8', autostrip=True, ndmin=1)
+        puntos = {}
+        for fabricante, familia, I_f, t, I in datos:
+            curva = puntos.setdefault((str(fabricante), str(familia)), {})
+            curva.setdefault(float(I_f), []).append((t, I))
+
+        for clave, curvas in puntos.items():
+            calibres = sorted(curvas)
+            if len({len(curvas[I_f]) for I_f in calibres}) != 1:
+                raise ValueError(
+                    f"Las curvas de {clave[0]} {clave[1]} no tienen todas la misma cantidad de puntos")
+            tabla = np.array([curvas[I_f] for I_f in calibres], dtype=float)
+            familia = (np.array(calibres), np.ascontiguousarray(tabla[:, :, 1]),
+                       np.ascontiguousarray(tabla[:, :, 0]))
+            for array in familia:
+                array.setflags(write=False)
+            self.familias[clave] = familia
+        self.version = self._sha1.hexdigest()
+
+    def curve(self, I_f: float, familia: str = "gG", fabricante: str = "generico",
+              busqueda: str = "exacto") -> Curva:
+        """
+        Devuelve la curva de fusion del calibre I_f.
+
+        Parameters
+        ----------
+        I_f : float
+            Calibre del fusible (A).
+        familia, fabricante : str
+            Familia de curvas (gG, aM, ...) y fabricante.
+        busqueda : str
+            "exacto" exige que el calibre este en el catalogo, "cercano" usa
+            el calibre mas proximo en escala logaritmica e "interpolado"
+            interpola en escala log-log entre los dos calibres vecinos.
+        """
+        if (fabricante, familia) not in self.familias:
+            disponibles = ', '.join(f"{f} {g}" for f, g in self.familias)
+            raise ValueError(
+                f"No hay curvas de fusibles {familia} de {fabricante}. Disponibles: {disponibles}")
+        calibres, I, t = self.familias[(fabricante, familia)]
+
+        i = np.searchsorted(calibres, I_f)
+        if i < len(calibres) and calibres[i] == I_f:
+            return Curva(I=I[i], t=t[i])
+        if busqueda == "cercano":
+            i = np.argmin(np.abs(np.log(calibres / I_f)))
+            return Curva(I=I[i], t=t[i])
+        if busqueda == "interpolado" and 0 < i < len(calibres):
+            w = np.log(I_f / calibres[i-1]) / np.log(calibres[i] / calibres[i-1])
+            return Curva(I=np.exp((1 - w) * np.log(I[i-1]) + w * np.log(I[i])),
+                         t=np.exp((1 - w) * np.log(t[i-1]) + w * np.log(t[i])))
+        raise ValueError(
+            f"No hay un fusible {familia} de {fabricante} de {round_to_text(I_f)}A. "
+            f"Calibres disponibles: {', '.join(round_to_text(c) for c in calibres)}")
+
+
+CATALOGO_FUSIBLES = CatalogoFusibles(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fusibles.csv"))
+
+
+# Las curvas se guardan por los parametros del dispositivo, asi los
+# dispositivos iguales (cientos de termicas de 16A C) comparten la misma curva
+CURVE_CACHE_SIZE = 4096
+
+
+def _frozen(curva: Curva) -> Curva:
+    """
+    Marca los arrays de la curva como de solo lectura, porque la curva se
+    comparte entre todos los dispositivos con los mismos parametros
+    """
+    for array in (curva.I, curva.t, curva._log_I, curva._log_t):
+        array.setflags(write=False)
+    return curva
+
+
+@lru_cache(maxsize=CURVE_CACHE_SIZE)
+def _fusible_curve(version: str, I_f: float, familia: str, fabricante: str,
+                   busqueda: str) -> Curva:
+    # la version del catalogo es parte de la clave, al cargar otro archivo
+    # no se usan las curvas anteriores
+    return _frozen(CATALOGO_FUSIBLES.curve(I_f, familia=familia, fabricante=fabricante,
+                                           busqueda=busqueda))
+
+
+def _m_curve_points(I_t, I_r, t_r, I_sd, t_sd, I_i, t_i) -> tuple:
+    """
+    Devuelve los puntos (I, t) de las curvas M de muchos ajustes a la vez,
+    una fila de 7 puntos por ajuste. Sin retardo corto (I_sd = 0) la curva
+    tiene 5 puntos, y el ultimo se repite para completar los 7.
+    """
+    I_t, I_r, t_r, I_sd, t_sd, I_i, t_i = (
+        np.atleast_1d(x) for x in np.broadcast_arrays(
+            *(np.asarray(x, dtype=float) for x in (I_t, I_r, t_r, I_sd, t_sd, I_i, t_i))))
+    off = (I_sd == 0)[:, None]
+    I_max = np.full(I_t.shape, 10e7)
+    t_max = np.full(I_t.shape, 10e6)
+    I = np.where(off,
+                 np.column_stack([I_r*I_t, I_r*I_t, I_i*I_t, I_i*I_t, I_max, I_max, I_max]),
+                 np.column_stack([I_r*I_t, I_r*I_t, I_sd*I_t, I_sd*I_t, I_i*I_t, I_i*I_t, I_max]))
+    t = np.where(off,
+                 np.column_stack([t_max, t_r*I_i*30, t_r, t_i, t_i, t_i, t_i]),
+                 np.column_stack([t_max, t_r*I_sd*30, t_r, t_sd, t_sd, t_i, t_i]))
+    return I, t
+
+
+@lru_cache(maxsize=CURVE_CACHE_SIZE)
+def _termica_curve(curva: str, I_t: float, I_r: float, t_r: float, I_sd: float,
+                   t_sd: float, I_i: float, t_i: float) -> Curva:
+    t = np.array([10e6, 60*240, 60*10, 40, 8, 2, 0.8, 0.05,
+                  0.03, 0.02, 0.012, 0.003])  # s
+    if curva == "C":
+        I_termica = np.array(
+            [1.13, 1.13, 1.25, 1.5, 2, 3, 5, 5, 5.3, 6.4, 90, 100000])
+        I_termica = I_termica * I_t
+    else:
+        I_termica, t = _m_curve_points(I_t, I_r, t_r, I_sd or 0, t_sd, I_i, t_i)
+        points = 7 if I_sd else 5
+        I_termica, t = I_termica[0, :points], t[0, :points]
+    return _frozen(Curva(I=I_termica, t=t))
+
+
+@lru_cache(maxsize=CURVE_CACHE_SIZE)
+def _conductor_curve(K: float, S: float, I_adm: float) -> Curva:
+    t = np.logspace(-3, 6)  # s
+    # por debajo de I_adm el conductor soporta la corriente indefinidamente
+    I = np.fmax(K * S / np.sqrt(t), I_adm)  # A
+    return _frozen(Curva(I=I, t=t))
+
+
+def curve_cache_info() -> dict:
+    """
+    Devuelve los aciertos, fallos y tamaño de la cache de curvas de cada tipo
+    de dispositivo
+    """
+    return {name: function.cache_info()._asdict() for name, function in (
+        ("Fusible", _fusible_curve), ("Termica", _termica_curve),
+        ("Conductor", _conductor_curve))}
+
+
+def clear_curve_cache():
+    for function in (_fusible_curve, _termica_curve, _conductor_curve):
+        function.cache_clear()
+
+
+@dataclass(slots=True)
 class Fusible():
     I_f: float
     name: str = field(default="fusible")
+    familia: str = "gG"
+    fabricante: str = "generico"
+    busqueda: str = "exacto"
+
+    def curve(self) -> Curva:
+        """
+        Devuelve la curva de fusion del fusible
+        """
+        return _fusible_curve(CATALOGO_FUSIBLES.version, self.I_f, self.familia,
+                              self.fabricante, self.busqueda)
+
+    def trip_time(self, I: np.ndarray) -> np.ndarray:
+        return self.curve().trip_time(I)
+
+    def trip_current(self, t: np.ndarray) -> np.ndarray:
+        return self.curve().trip_current(t)
 
     def plot(self, color: str, ax: plt.Axes, *args, **kwargs):
-        tiempo_1 = [0.001, 0.01862087136662867, 0.04875284901033861, 0.09999999999999998, 0.4875284901033862, 1.0, 4.875284901033865,
-                    10.000000000000002, 48.752849010338664, 100.00000000000004, 487.5284901033861, 1000.0000000000007, 1148.1536214968828]
-        tiempo_2 = [0.001, 0.01862087136662867, 0.04875284901033861, 0.09999999999999998, 0.4875284901033862, 1.0, 4.875284901033865,
-                    10.000000000000002, 48.752849010338664, 100.00000000000004, 487.5284901033861, 1000.0000000000007, 3311.3112148259115]
-        tiempo_3 = [0.001, 0.01862087136662867, 0.04875284901033861, 0.09999999999999998, 0.4875284901033862, 1.0, 4.875284901033865,
-                    10.000000000000002, 48.752849010338664, 100.00000000000004, 487.5284901033861, 1000.0000000000007, 3981.07170553497]
-        fusibles = {
-            6: {'t': tiempo_1, 'I': [239.88329190194912, 88.71560120379613, 68.07693586937418, 56.36376558259544, 38.72576449216175, 33.11311214825913, 23.442288153199236, 20.55890595984142, 15.776112696993486, 14.387985782558454, 12.302687708123818, 11.534532578210925, 11.428783347897722]},
-            10: {'t': tiempo_1, 'I': [354.81338923357566, 139.31568029453047, 104.47202192208005, 86.09937521846008, 57.94286964268813, 49.20395356814511, 35.07518739525681, 30.76096814740709, 23.988329190194907, 22.387211385683404, 19.952623149688804, 19.142559250210862, 19.054607179632477]},
-            16: {'t': tiempo_1, 'I': [512.8613839913652, 199.52623149688802, 153.46169827992946, 125.31411749414158, 82.03515443298187, 69.18309709189366, 49.317380395493615, 43.05266104917107, 34.119291162192866, 31.1171633710602, 27.227013080779138, 25.82260190634596, 25.585858869056462]},
-            20: {'t': tiempo_1, 'I': [724.4359600749902, 316.22776601683825, 245.4708915685033, 199.06733389871874, 130.0169578033291, 107.15193052376065, 75.33555637337177, 65.01296903430907, 48.194779762512745, 43.55118736855688, 34.994516702835746, 32.433961734934925, 32.13660538640317]},
-            25: {'t': tiempo_1, 'I': [891.2509381337466, 398.1071705534976, 300.6076302628233, 242.66100950824162, 162.55487557504838, 136.45831365889245, 92.04495717531714, 79.79946872679767, 60.39486293763802, 53.333489548762124, 43.85306977749857, 40.83193863326923, 40.17908108489401]},
-            32: {'t': tiempo_1, 'I': [1122.0184543019636, 475.33522594280566, 358.9219346450057, 295.8012466551549, 198.15270258050998, 165.95869074375622, 117.21953655481305, 103.0386120441616, 77.62471166286922, 69.18309709189366, 54.32503314924336, 51.522864458175654, 51.522864458175654]},
-            40: {'t': tiempo_1, 'I': [1412.5375446227545, 630.9573444801932, 496.59232145033644, 411.14972110452226, 271.01916318908434, 229.08676527677744, 162.92960326397235, 142.232878712282, 105.9253725177289, 93.54056741475524, 70.95777679633893, 65.01296903430907, 64.12095765851618]},
-            50: {'t': tiempo_1, 'I': [1995.2623149688804, 851.1380382023776, 636.7955209079158, 526.0172663907065, 345.9393778261222, 291.7427014001168, 207.96966871036966, 181.55156627731353, 133.04544179780916, 117.48975549395293, 88.92011178579486, 81.84647881347904, 80.16780633876796]},
-            63: {'t': tiempo_1, 'I': [2630.2679918953822, 1091.4403364487573, 866.9618757582173, 707.9457843841387, 453.94161665020357, 376.7037989839092, 259.4179362118817, 228.034207200042, 169.82436524617444, 151.3561248436209, 115.34532578210927, 103.2761405761397, 101.39113857366796]},
-            80: {'t': tiempo_2, 'I': [3548.133892335754, 1592.2087270511718, 1282.3305826560227, 1083.9269140212048, 711.213513653329, 586.1381645140291, 403.64539296760523, 348.3373150360119, 247.74220576332866, 216.2718523727022, 157.03628043335542, 141.57937799570811, 124.16523075924107]},
-            100: {'t': tiempo_2, 'I': [4466.835921509634, 1995.2623149688804, 1603.2453906900423, 1348.962882591654, 887.1560120379614, 734.5138681571156, 506.9907082747048, 434.51022417157156, 311.17163371060195, 268.5344445658508, 196.3360276836048, 177.0108958317423, 154.8816618912482]},
-            125: {'t': tiempo_2, 'I': [5623.413251903499, 2511.886431509581, 2018.3663636815636, 1690.4409316432666, 1106.6237839776668, 918.3325964835813, 628.0583588133181, 542.0008904016242, 398.1071705534976, 348.3373150360119, 258.82129151530927, 227.5097430772073, 195.43394557753948]},
-            160: {'t': tiempo_2, 'I': [7079.457843841383, 3349.654391578277, 2685.344445658508, 2238.7211385683418, 1482.5180851459545, 1230.2687708123824, 833.6811846196346, 724.4359600749902, 533.3348954876211, 467.7351412871983, 346.7368504525318, 304.78949896279846, 247.17241450161296]},
-            200: {'t': tiempo_2, 'I': [9120.108393559109, 4466.835921509634, 3589.219346450058, 2999.1625189876513, 1954.3394557753952, 1629.296032639724, 1101.539309541415, 939.7233105646382, 688.6522963442766, 601.1737374832782, 443.6086439314326, 388.15036599064837, 322.10687912834356]},
-            250: {'t': tiempo_2, 'I': [11748.975549395318, 5623.413251903499, 4477.133041763624, 3732.5015779572095, 2471.72414501613, 2051.162178825565, 1374.041975012516, 1180.3206356517303, 851.1380382023776, 749.8942093324565, 552.0774392807579, 485.28850016212147, 402.71703432545945]},
-            315: {'t': tiempo_2, 'I': [15488.166189124853, 7079.457843841383, 5610.479760324709, 4655.860935229593, 3097.4192992165836, 2552.701302661249, 1725.8378919902048, 1479.1083881682086, 1078.9467222298294, 939.7233105646382, 687.0684400142328, 608.135001278718, 509.3308710571956]},
-            400: {'t': tiempo_2, 'I': [22908.67652767775, 10000.00000000001, 7585.775750291839, 6194.410750767819, 3908.4089579240235, 3258.3670100200893, 2197.859872784826, 1896.7059212111483, 1361.4446824659506, 1199.49930314938, 868.9604292863023, 770.9034690644304, 645.6542290346559]},
-            500: {'t': tiempo_3, 'I': [31622.77660168384, 13335.214321633259, 10162.486928706961, 8336.811846196348, 5432.503314924331, 4456.562483975033, 3019.9517204020176, 2606.153549998898, 1866.3796908346708, 1621.8100973589308, 1172.1953655481307, 1030.3861204416162, 807.2350302488384]},
-            630: {'t': tiempo_3, 'I': [39810.71705534974, 18836.490894898037, 14554.590805819682, 11939.88104464275, 8128.305161641007, 6839.116472814298, 4497.798548932884, 3810.6582339377314, 2666.858664521482, 2290.867652767775, 1581.2480392703844, 1352.0725631942773, 1023.2929922807547]},
-            800: {'t': tiempo_3, 'I': [56234.13251903495, 24490.632418447498, 18879.913490962947, 15488.166189124853, 10471.285480509003, 8830.799004185646, 5970.352865838369, 5035.006087879056, 3443.4993076333894, 2904.0226544644534, 1972.4227361148548, 1682.674061070469, 1288.2495516931347]},
-            1000: {'t': tiempo_3, 'I': [70794.57843841378, 30760.96814740714, 23659.196974857587, 19408.85877592782, 13182.56738556409, 11040.78619902074, 7328.245331389056, 6208.690342300644, 4315.1907682776555, 3689.775985701507, 2477.422057633287, 2074.9135174549115, 1621.8100973589308]},
-            1250: {'t': tiempo_3, 'I': [100000.0000000002, 43151.90768277653, 33189.44575526104, 27227.013080779132, 18323.144223712126, 15417.004529495585, 10000.00000000001, 8413.95141645195, 5584.701947368314, 4677.351412871984, 3083.1879502493534, 2612.1613543992084, 2041.7379446695318]}
-        }
-
-        ax.loglog(fusibles[self.I_f]['I'], fusibles[self.I_f]
-                  ['t'], color=lighten_color(color, 0.75), linestyle='-.', label=f'{self.name}   {round_to_text(self.I_f)}A')
+        curva = self.curve()
+        ax.loglog(curva.I, curva.t, color=lighten_color(color, 0.75), linestyle='-.',
+                  label=f'{self.name}   {round_to_text(self.I_f)}A')
 
 
-@dataclass
+@dataclass(slots=True)
 class Termica():
     I_t: float
     I_cc: float
@@ -200,29 +660,29 @@ class Termica():
     I_i: float = 15
     t_i: float = 0.02
 
+    def curve(self) -> Curva:
+        """
+        Devuelve la curva de disparo de la termica
+        """
+        if self.curva not in ("C", "M"):
+            raise ValueError(
+                f"La curva {self.curva} de {self.name} no esta soportada")
+        return _termica_curve(self.curva, self.I_t, self.I_r, self.t_r,
+                              self.I_sd, self.t_sd, self.I_i, self.t_i)
+
+    def trip_time(self, I: np.ndarray) -> np.ndarray:
+        return self.curve().trip_time(I)
+
+    def trip_current(self, t: np.ndarray) -> np.ndarray:
+        return self.curve().trip_current(t)
+
     def plot(self, ax: plt.Axes, color: tuple = None, *args, **kwargs):
-        t = np.array([10e6, 60*240, 60*10, 40, 8, 2, 0.8, 0.05,
-                      0.03, 0.02, 0.012, 0.003])  # s
-        if self.curva == "C":
-            I_termica = np.array(
-                [1.13, 1.13, 1.25, 1.5, 2, 3, 5, 5, 5.3, 6.4, 90, 100000])
-            I_termica = I_termica * self.I_t
-        elif self.curva == "M":
-            if self.I_sd:
-                I_termica = [self.I_r*self.I_t, self.I_r*self.I_t, self.I_sd*self.I_t,
-                             self.I_sd*self.I_t, self.I_i*self.I_t, self.I_i*self.I_t, 10e7]
-                t = [10e6, self.t_r*self.I_sd*30, self.t_r,
-                     self.t_sd, self.t_sd, self.t_i, self.t_i]
-            else:
-                I_termica = [self.I_r*self.I_t, self.I_r*self.I_t,
-                             self.I_i*self.I_t, self.I_i*self.I_t, 10e7]
-                t = [10e6, self.t_r*self.I_i*30, self.t_r, self.t_i, self.t_i]
-
-        ax.loglog(I_termica, t, color=lighten_color(color, 0.75), linestyle='--',
+        curva = self.curve()
+        ax.loglog(curva.I, curva.t, color=lighten_color(color, 0.75), linestyle='--',
                   label=f'{self.name}   {round_to_text(self.I_t)}A')
 
 
-@dataclass
+@dataclass(slots=True)
 class Proteccion(Nodo):
     name: str = field(default="protection")
     child: Nodo = None
@@ -235,6 +695,24 @@ class Proteccion(Nodo):
     def add_termica(self, termica: dict):
         self.termica = termica
 
+    def trip_time(self, I: np.ndarray) -> np.ndarray:
+        """
+        Devuelve el tiempo de actuacion de la proteccion: el menor entre el
+        fusible y la termica, o np.inf si no tiene ninguno
+        """
+        t = np.full(np.shape(I), np.inf)
+        for dispositivo in (self.fusible, self.termica):
+            if dispositivo is not None:
+                t = np.minimum(t, dispositivo.trip_time(I))
+        return t
+
+    def trip_current(self, t: np.ndarray) -> np.ndarray:
+        I = np.full(np.shape(t), np.inf)
+        for dispositivo in (self.fusible, self.termica):
+            if dispositivo is not None:
+                I = np.minimum(I, dispositivo.trip_current(t))
+        return I
+
     def plot(self, ax: plt.Axes, color: tuple = None, *args, **kwargs):
         if self.fusible is not None:
             self.fusible.plot(ax=ax, color=color, *args, **kwargs)
@@ -242,28 +720,41 @@ class Proteccion(Nodo):
             self.termica.plot(ax=ax, color=color, *args, **kwargs)
 
 
-@dataclass
+@dataclass(slots=True)
 class Carga(Nodo, GraphicCreator):
     name: str = field(default="carga")
     P: float = 0
     cos_phi: float = 1
     I_n: float = 0
     max_caida: float = 0.05
+    # corrientes de cortocircuito maxima y minima (A)
+    I_cc: float = 0
+    I_cc_min: float = 0
 
+    def add_child(self, child: Optional['Nodo']):
+        return
 
-@dataclass
-class Barra(Nodo, GraphicCreator):
+    def remove_child(self, child: 'Nodo'):
+        return
+
+    def get_children(self):
+        return None
+
+
+@dataclass(slots=True)
+class Barra(_Hijos, Nodo, GraphicCreator):
     name: str = field(default="barra")
     children: list = field(default_factory=list)
     I_cc: float = 0
+    I_cc_min: float = 0
 
     def add_children(self, children: list):
         self.children = children
         for child in children:
-            child.parent = self
+            child.set_parent(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class Conductor(Nodo):
     name: str = field(default="conductor")
     child: Nodo = None
@@ -276,29 +767,141 @@ class Conductor(Nodo):
         """
         Devuelve el siguiente color en la paleta
         """
-        level = 0
-        nodo = self
-        cmap = ListedColormap(["#A00000", "#4964AB", "#182239", "black"])
-        while nodo.parent is not None:
-            if isinstance(nodo, Conductor):
-                level += 1
-            nodo = nodo.parent
+        from matplotlib import cm
+        return cm.tab10(self.conductor_level % 10)
 
-        # return cmap(4 - level % 4)
-        return plt.cm.tab10(level % 10)
+    def curve(self) -> Curva:
+        """
+        Devuelve la curva de calentamiento admisible del conductor
+        """
+        return _conductor_curve(self.K, self.S, self.I_adm)
+
+    def trip_time(self, I: np.ndarray) -> np.ndarray:
+        """
+        Devuelve el tiempo que el conductor soporta cada corriente I (A).
+        Por debajo de I_adm el tiempo es np.inf
+        """
+        return self.curve().trip_time(I)
+
+    def trip_current(self, t: np.ndarray) -> np.ndarray:
+        return self.curve().trip_current(t)
 
     def plot(self, ax: plt.Axes, color: tuple = None, *args, **kwargs):
-        t = np.logspace(-3, 6)  # s
-        I_adm = self.K * self.S / np.sqrt(t)  # A
-        for i in range(len(I_adm)):
-            if I_adm[i] < self.I_adm:
-                I_adm[i] = self.I_adm
-        ax.loglog(I_adm, t, color=lighten_color(color, 0.5), linestyle='-',
+        curva = self.curve()
+        ax.loglog(curva.I, curva.t, color=lighten_color(color, 0.5), linestyle='-',
                   label=f'{self.name}   {round_to_text(self.S)}mm²')
         ax.plot([self.I_n, self.I_n], [0.001, 1e6], color=color, linestyle=':',
                 label=f'I_n={round_to_text(self.I_n)}A')
 
 
+# Tipos de nodo que se pueden guardar con tree_to_arrays
+_NODE_TYPES = {cls.__name__: cls for cls in (Red, Barra, Carga, Proteccion, Conductor)}
+
+
+def _init_fields(cls) -> tuple:
+    return tuple(f.name for f in fields(cls) if f.init)
+
+
+def tree_schema() -> tuple:
+    """
+    Devuelve los campos de cada tipo de nodo y de dispositivo, en el orden en
+    que tree_to_arrays y pickle guardan sus valores. Si cambia el orden o el
+    nombre de un campo cambia el esquema, y un arbol guardado antes ya no se
+    puede volver a crear con los valores en su lugar.
+    """
+    return tuple((name, _init_fields(cls)) for name, cls in _NODE_TYPES.items()) + tuple(
+        (cls.__name__, tuple(f.name for f in fields(cls))) for cls in (Fusible, Termica))
+
+
+def _unlinked(nodo: Nodo, names: tuple) -> tuple:
+    """
+    Argumentos para crear una copia del nodo sin sus enlaces del arbol
+    """
+    return tuple(None if name in ("parent", "child") else [] if name == "children"
+                 else getattr(nodo, name) for name in names)
+
+
+@contextmanager
+def paused_gc():
+    """
+    Pausa el recolector de ciclos mientras se crean muchos nodos: cada nodo
+    nuevo cuenta para la recoleccion, que recorre todos los nodos ya creados
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def tree_root(items: dict) -> Red:
+    """
+    Devuelve la Red en la raiz del arbol de items, que tiene todas las
+    protecciones alimentadas desde la red, o una Red vacia si no hay items
+    """
+    return next(iter(items.values())).root if items else Red()
+
+
+def flatten_tree(root: Nodo) -> tuple:
+    """
+    Recorre el arbol en preorden sin recursion.
+
+    Returns
+    -------
+    tuple
+        La lista de nodos y un array con la posicion del padre de cada nodo
+        (-1 para la raiz). Los descendientes de un nodo son los que le siguen
+        hasta el primer nodo con una profundidad igual o menor.
+    """
+    nodes = []
+    parents = []
+    stack = [(root, -1)]
+    while stack:
+        nodo, parent = stack.pop()
+        if nodo is None:
+            continue
+        parents.append(parent)
+        nodes.append(nodo)
+        children = nodo.get_children()
+        if children:
+            stack.extend((child, len(nodes) - 1) for child in reversed(children))
+    return nodes, np.array(parents, dtype=np.int64)
+
+
+def tree_to_arrays(nodes: list, parents: np.ndarray) -> dict:
+    """
+    Devuelve el arbol recorrido con flatten_tree como arrays planos, sin los
+    enlaces entre nodos, para guardarlo con pickle sin recursion: el tipo y los
+    argumentos de cada nodo en preorden, y la posicion del padre de cada uno.
+    """
+    names = {}
+    tipos = []
+    valores = []
+    for nodo in nodes:
+        cls = type(nodo)
+        if cls not in names:
+            names[cls] = _init_fields(cls)
+        tipos.append(cls.__name__)
+        valores.append(_unlinked(nodo, names[cls]))
+    return {"tipos": tipos, "valores": valores, "padres": parents}
+
+
+def tree_from_arrays(data: dict) -> list:
+    """
+    Vuelve a crear los nodos guardados con tree_to_arrays y los conecta.
+    Devuelve la lista de nodos en preorden, el primero es la raiz.
+    """
+    with paused_gc():
+        nodes = [_NODE_TYPES[tipo](*valores)
+                 for tipo, valores in zip(data["tipos"], data["valores"])]
+        for nodo, parent in zip(nodes, data["padres"].tolist()):
+            if parent != -1:
+                nodes[parent].add_child(nodo)
+    return nodes
+
+
 # Ejercicio Ema pag 328:
 #                        I_carga    I_cond  I_selec     I_termica       I_Corte     I_select_f  I_f     I_cc        I_ccMax
 # Térmica del TS5       [25.53,     256,    64,         Sica 63,        10,         75.6,       80,     68.67,      9.9]
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+import metricas
+from clases import Conductor, Proteccion, flatten_tree, tree_root
+from selectividad import _given
+
+# Resistivity at 20 °C (ohm mm²/m) of copper and aluminium. The conductors
+# with K < 100 (76 PVC, 94 XLPE) are taken as aluminium.
+_RHO_CU = 0.01786
+_RHO_AL = 0.02857
+# Reactance of the cables (ohm/m)
+_X = 0.08e-3
+# Resistance at the end of the fault, for the minimum current
+_HOT = 1.5
+
+
+def _source_currents(nodes: list, top: np.ndarray, I_cc) -> np.ndarray:
+    """
+    Short-circuit current at the bus or load of each protection fed from the
+    network: I_cc if it is a number, I_cc[name] if it is a dict or Series,
+    and otherwise the I_cc already set in the node (see selectividad._given).
+    """
+    currents = []
+    for i in top:
+        leaf = nodes[i].child.child if isinstance(nodes[i].child, Conductor) else nodes[i].child
+        name = leaf.name if leaf is not None else None
+        currents.append(_given(I_cc, name, getattr(leaf, "I_cc", 0)))
+    return np.array(currents, dtype=float)
+
+
+@metricas.timed("short_circuit")
+def short_circuit(df: pd.DataFrame, items: dict, I_cc=None, longitudes=None,
+                  tension: float = 400, c_max: float = 1.05,
+                  c_min: float = 0.95) -> pd.DataFrame:
+    """
+    Computes the maximum and minimum prospective short-circuit currents of
+    every bus and load, starting from the currents at the buses fed from the
+    network, and checks the breaking capacity (I_cc) of the Termica of each
+    item.
+
+    The impedance of each conductor is derived from its section S, its length
+    and its material (aluminium if K < 100). The tree is flattened into arrays
+    in preorder, so the impedances are accumulated from the network down in
+    a single pass, in linear time.
+
+    - The maximum current is a three-phase fault with the conductors at
+      20 °C: c_max * U / (√3 |Z|).
+    - The minimum current is a phase-neutral fault with the conductors at the
+      end of the fault (1.5 times the resistance), and the neutral equal to
+      the phase: c_min * U / (√3 |Z_fuente + 2 Z_conductores|).
+
+    The source is purely reactive, with the impedance that gives I_cc with
+    c_max. The conductor of the items fed from the network is not counted:
+    their current is the one given.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame of the items, as returned by get_data.
+    items : dict
+        Dictionary with the items of the tree built from df.
+    I_cc : float or dict, optional
+        Short-circuit current (A) at the buses fed from the network, the same
+        for all of them or by name. The ones not given keep the I_cc of their
+        node, and without it the items fed from them are left as NaN.
+    longitudes : dict or pd.Series, optional
+        Length (m) of the conductor that feeds each item, by name. The missing
+        lengths are 0.
+    tension : float, optional
+        Line voltage (V), 400 V by default.
+    c_max, c_min : float, optional
+        Voltage factors of the maximum and minimum currents (IEC 60909).
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of df with the columns I_cc and I_cc_min, which create_tree
+        puts in the Barra and Carga of each row to mark them in its plot. The
+        nodes of items are updated too. df.attrs["cortocircuito"] is a list of
+        records, one per item, with the keys:
+
+        - nombre, I_cc, I_cc_min: the currents at the bus or load.
+        - I_cc_proteccion: the maximum current at the protection of the item,
+          the one of the bus that feeds it.
+        - poder_de_corte: the I_cc of the Termica of the item.
+        - corte_insuficiente: True if it is below I_cc_proteccion.
+    """
+    if longitudes is None:
+        longitudes = {}
+    elif isinstance(longitudes, pd.Series):
+        longitudes = longitudes.to_dict()
+    nodes, parents = flatten_tree(tree_root(items))
+    length = len(nodes)
+
+    # impedance of each conductor at 20 °C (R + jX), 0 for the other nodes
+    R = np.zeros(length)
+    X = np.zeros(length)
+    conductors = np.array([i for i, nodo in enumerate(nodes) if isinstance(nodo, Conductor)],
+                          dtype=np.int64)
+    if len(conductors):
+        cables = [nodes[i] for i in conductors]
+        S = np.array([np.nan if cable.S is None else cable.S for cable in cables], dtype=float)
+        K = np.array([np.nan if cable.K is None else cable.K for cable in cables], dtype=float)
+        L = np.array([longitudes.get(cable.child.name, 0) if cable.child is not None else 0
+                      for cable in cables], dtype=float)
+        L = np.nan_to_num(L)
+        rho = np.where(K < 100, _RHO_AL, _RHO_CU)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R[conductors] = np.where(L > 0, rho * L / S, 0)
+        X[conductors] = _X * L
+
+    # the protections fed from the network, and their conductor
+    top = np.flatnonzero(parents == 0)
+    fed = conductors[np.isin(parents[conductors], top)]
+    R[fed] = 0
+    X[fed] = 0
+
+    U = tension / np.sqrt(3)
+    Z_max = np.full(length, np.nan, dtype=complex)
+    Z_min = np.full(length, np.nan, dtype=complex)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Z_source = 1j * c_max * U / _source_currents(nodes, top, I_cc)
+    Z_max[top] = Z_source
+    Z_min[top] = Z_source
+    # the parents come before their children, the nodes below the
+    # protections fed from the network add their impedance to the parent's
+    Z_max = Z_max.tolist()
+    Z_min = Z_min.tolist()
+    z_max = (R + 1j * X).tolist()
+    z_min = (2 * (_HOT * R + 1j * X)).tolist()
+    for i, parent in enumerate(parents.tolist()):
+        if parent > 0:
+            Z_max[i] = Z_max[parent] + z_max[i]
+            Z_min[i] = Z_min[parent] + z_min[i]
+    Z_max = np.array(Z_max)
+    Z_min = np.array(Z_min)
+
+    with np.errstate(divide='ignore'):
+        I_max = c_max * U / np.abs(Z_max)
+        I_min = c_min * U / np.abs(Z_min)
+
+    position = {id(nodo): i for i, nodo in enumerate(nodes)}
+    names = df["nombre"].tolist()
+    leaves = [position[id(items[name])] for name in names]
+    protections = []
+    capacity = []
+    for name in names:
+        proteccion = items[name]
+        while proteccion is not None and not isinstance(proteccion, Proteccion):
+            proteccion = proteccion.parent
+        protections.append(position[id(proteccion)])
+        termica = proteccion.termica
+        capacity.append(termica.I_cc if termica is not None and termica.I_cc else np.nan)
+
+    report = pd.DataFrame({
+        "nombre": names,
+        "I_cc": I_max[leaves],
+        "I_cc_min": I_min[leaves],
+        "I_cc_proteccion": I_max[protections],
+        "poder_de_corte": np.array(capacity, dtype=float),
+    })
+    report["corte_insuficiente"] = report["poder_de_corte"] < report["I_cc_proteccion"]
+
+    for name, maximum, minimum in zip(names, report["I_cc"].tolist(), report["I_cc_min"].tolist()):
+        items[name].I_cc = maximum
+        items[name].I_cc_min = minimum
+    computed = df.copy()
+    computed["I_cc"] = report["I_cc"].to_numpy()
+    computed["I_cc_min"] = report["I_cc_min"].to_numpy()
+    computed.attrs = dict(df.attrs, cortocircuito=report.to_dict("records"))
+    return computed
@@ -1,19 +1,45 @@
+import hashlib
+import io
 import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import fields, is_dataclass
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import metricas
 from clases import *
+from fuentes import CacheFuente, create_source
+from seleccion import Indice
+from selectividad import analyze_let_through, analyze_selectivity, save_report
 
 
 def get_url() -> str:
     """
     Reads the url from a text file and extracts the gid from the url.
     Returns the url in the format of 'https://docs.google.com/spreadsheets/d/.../export?gid=...&format=csv'
+
+    If the text file has any other url or the path of a local CSV/XLSX file,
+    it is returned as is. If it has several lines, the first one is used (see
+    get_urls).
+    """
+    return get_urls()[0]
+
+
+def get_urls() -> list:
+    """
+    Reads the urls of all the tabs or files of the single-line diagram from
+    the text file, one per line (see get_url). Empty lines and lines starting
+    with # are skipped.
     """
     with open("google_sheets_name.txt", "r") as f:
-        file = f.read()
+        lines = [line.strip() for line in f]
+    return [_export_url(line) for line in lines if line and not line.startswith("#")]
+
 
-    url_raw = file.strip()
+def _export_url(url_raw: str) -> str:
+    if "docs.google.com/spreadsheets" not in url_raw:
+        return url_raw
     url_1, url_2 = url_raw.split('?')
     url_1 = '/'.join(url_1.split('/')[:-1])
     url_2 = url_2[url_2.find('gid=') + 4:]
@@ -28,65 +54,345 @@ def get_url() -> str:
     return url
 
 
-def get_data(url) -> pd.DataFrame:
+# Caches of the sources already loaded, by location
+_caches = {}
+# Version of the output of parse_data, saved with the cached DataFrames.
+# Increase it when its columns or attrs change.
+_PARSE_VERSION = 1
+
+
+def get_data(url, cache: bool = True, refresh: bool = True) -> pd.DataFrame:
     """
     Download the file and read it into a pandas DataFrame
 
+    Parameters
+    ----------
+    url : str or fuentes.Fuente
+        Url of the CSV export, path of a local CSV/XLSX file, or a source.
+    cache : bool, optional
+        If True (the default), the parsed DataFrame is kept in memory and in
+        the "cache" folder, and it is reused while the data does not change.
+    refresh : bool, optional
+        If False, a cached DataFrame is returned without reading the source.
+
+    Returns
+    -------
+    pd.DataFrame
+        The same object as the previous call if the data did not change.
+    """
+    fuente = create_source(url) if isinstance(url, str) else url
+    if not cache:
+        with metricas.stage("descarga"):
+            data = fuente.read({})
+        return parse_data(io.BytesIO(data), fuente.formato)
+    if fuente.location not in _caches:
+        _caches[fuente.location] = CacheFuente(fuente, parse_data, version=_PARSE_VERSION)
+    return _caches[fuente.location].load(refresh=refresh)
+
+
+# Merged DataFrames of several sources, by their locations, next to the parts
+_merged = {}
+
+
+def get_data_multiple(urls: list, cache: bool = True, refresh: bool = True,
+                      workers: int = None) -> pd.DataFrame:
+    """
+    Loads several sources at the same time (for example one tab per
+    substation) and merges them in one DataFrame, see merge_data. The feeders
+    of a sheet can be in another one.
+
+    Parameters
+    ----------
+    urls : list
+        Urls, paths or sources, as accepted by get_data. With only one, its
+        DataFrame is returned as is.
+    cache, refresh : bool, optional
+        Passed to get_data for each source.
+    workers : int, optional
+        Number of threads that read the sources. By default one per source.
+
+    Returns
+    -------
+    pd.DataFrame
+        The same object as the previous call if none of the sources changed.
+
+    Raises
+    ------
+    ValueError
+        If any source could not be loaded. The message lists the error of
+        each one of them.
+    """
+    if len(urls) == 1:
+        return get_data(urls[0], cache=cache, refresh=refresh)
+    fuentes = [create_source(url) if isinstance(url, str) else url for url in urls]
+    with ThreadPoolExecutor(max_workers=workers or len(fuentes)) as pool:
+        futures = [pool.submit(get_data, fuente, cache, refresh) for fuente in fuentes]
+
+    dfs, errors = [], []
+    for fuente, future in zip(fuentes, futures):
+        try:
+            dfs.append(future.result())
+        except Exception as e:
+            errors.append(f"{fuente.location}: {type(e).__name__}: {e}")
+    if errors:
+        raise ValueError("No se pudieron cargar los datos de:\n" + "\n".join(errors))
+
+    origenes = tuple(fuente.location for fuente in fuentes)
+    parts, merged = _merged.get(origenes, ((), None))
+    if len(parts) != len(dfs) or any(a is not b for a, b in zip(parts, dfs)):
+        merged = merge_data(dfs, origenes)
+        _merged[origenes] = (tuple(dfs), merged)
+    return merged
+
+
+def merge_data(dfs: list, origenes: list) -> pd.DataFrame:
+    """
+    Concatenates the DataFrames of several sheets, adding the column "origen"
+    with the source of each row. The index is renumbered from 1, and the
+    invalid values of every sheet (df.attrs["errores"]) are kept, with their
+    row in their own sheet and their origin.
+    """
+    df = pd.concat([df.assign(origen=origen) for df, origen in zip(dfs, origenes)],
+                   ignore_index=True)
+    df.index = pd.RangeIndex(1, len(df) + 1)
+    df.attrs["errores"] = [dict(error, origen=origen) for df, origen in zip(dfs, origenes)
+                           for error in df.attrs.get("errores", [])]
+    return df
+
+
+# Columns B:AB of the sheet
+_COLUMNS = ['sector', 'carga', 'es_emergencia', 'nombre', 'I_n', 'cond_nombre',
+            'borrar_1', 'cond_S', 'cond_I_adm', 'cond_K', 'borrar_2', 'term_nombre', 'term_I_t', 'term_I_cc',
+            'term_I_r', 'term_t_r', 'term_I_sd', 'term_t_sd', 'term_I_i',
+            'term_curva', 'gm_nombre', 'gm_I_t', 'gm_I_cc', 'gm_curva', 'fus_nombre', 'fus_I_f',
+            'alimentador']
+_NUMERIC_COLUMNS = ["I_n", "cond_S", "cond_I_adm", "cond_K",
+                    'term_I_r', 'term_t_r', 'term_I_sd', 'term_t_sd', 'term_I_i',
+                    "term_I_t", "term_I_cc", "gm_I_t", "gm_I_cc", "fus_I_f"]
+# The data starts in row 5 of the sheet, index 1 of the DataFrame
+_FIRST_ROW = 4
+
+
+def _to_float(column: pd.Series) -> pd.Series:
+    """
+    Converts a column of text with numbers written with decimal comma or
+    point. Invalid values are returned as NaN.
+    """
+    text = column.dropna().astype(str).str.replace(',', '.').str.strip()
+    return pd.to_numeric(text, errors='coerce').reindex(column.index).astype(float)
+
+
+def _section(column: pd.Series) -> pd.Series:
+    """
+    Converts the cross-sections of the conductors, which can be written as
+    "95", "3x95" (the product of the factors) or "3x95/50" (the part after
+    the slash is ignored). Invalid values are returned as NaN.
+    """
+    values = _to_float(column)
+    compound = column[values.isna() & column.notna()].astype(str)
+    if len(compound):
+        factors = (compound.str.replace(',', '.').str.split('/').str[0]
+                   .str.split('x', expand=True))
+        numbers = factors.apply(
+            lambda factor: pd.to_numeric(factor.str.strip(), errors='coerce'))
+        invalid = (factors.notna() & numbers.isna()).any(axis=1)
+        values[compound.index] = numbers.prod(axis=1, min_count=1).mask(invalid)
+    return values
+
+
+@metricas.timed("parse_data")
+def parse_data(data, formato: str = "csv") -> pd.DataFrame:
+    """
+    Read the sheet into a pandas DataFrame and clean its columns
+
+    Parameters
+    ----------
+    data : str or file-like
+        Url, path or file-like object with the sheet.
+    formato : str, optional
+        "csv" (the default) or "xlsx".
+
     Returns
     -------
     pd.DataFrame
+        The rows without a name are skipped. The values that could not be
+        converted to numbers are left as NaN. They are listed, with the rows
+        without a name that have other data, in df.attrs["errores"], a
+        list of dicts with the keys fila (row of the sheet), nombre, columna
+        and valor.
     """
 
-    df = pd.read_csv(url,
-                     index_col=0,
-                     skiprows=2,
-                     )
-    df = df.iloc[:, :27]
-    df.columns = ['sector', 'carga', 'es_emergencia', 'nombre', 'I_n', 'cond_nombre',
-                  'borrar_1', 'cond_S', 'cond_I_adm', 'cond_K', 'borrar_2', 'term_nombre', 'term_I_t', 'term_I_cc',
-                  'term_I_r', 'term_t_r', 'term_I_sd', 'term_t_sd', 'term_I_i',
-                  'term_curva', 'gm_nombre', 'gm_I_t', 'gm_I_cc', 'gm_curva', 'fus_nombre', 'fus_I_f',
-                  'alimentador']
+    text_columns = [col for col in _COLUMNS if col not in _NUMERIC_COLUMNS]
+    options = dict(index_col=0,
+                   header=0,
+                   skiprows=[0, 1, 3],
+                   usecols=range(len(_COLUMNS) + 1),
+                   names=['indice'] + _COLUMNS,
+                   dtype={col: str for col in text_columns + ['cond_S']},
+                   )
+    if formato == "xlsx":
+        df = pd.read_excel(data, **options)
+    else:
+        df = pd.read_csv(data, decimal=',', low_memory=False, **options)
     df.drop(['borrar_1', 'borrar_2'], axis=1, inplace=True)
+    df.index = pd.RangeIndex(1, len(df) + 1)
 
-    df.reset_index(drop=True, inplace=True)
-    df.drop([0], axis=0, inplace=True)
+    # The rows without a name (like the blank rows at the end of the sheet)
+    # are not items. The ones that have other data are listed as errors.
+    errores = []
+    blank = df["nombre"].isna() | (df["nombre"].astype(str).str.strip() == "")
+    unnamed = blank & df.drop(columns="nombre").notna().any(axis=1)
+    if unnamed.any():
+        errores.append(pd.DataFrame({"fila": df.index[unnamed] + _FIRST_ROW,
+                                     "nombre": None, "columna": "nombre", "valor": None}))
+    df = df[~blank].copy()
 
     # Clean columns
 
     df["es_carga"] = df["carga"].notna()
     df["es_emergencia"] = df["es_emergencia"] == "SI"
 
-    def seccion(s):
-        if not type(s) == str:
-            return s
-        s = s.replace(",", ".")
-        if '/' in s:
-            s = s.split('/')[0]
-        if 'x' in s:
-            s = np.prod([float(x) for x in s.split('x')])
-        return float(s)
-
-    df["cond_S"] = df["cond_S"].apply(seccion)
-
-    num_cols = ["I_n", "cond_S", "cond_I_adm", "cond_K",
-                'term_I_r', 'term_t_r', 'term_I_sd', 'term_t_sd', 'term_I_i',
-                "term_I_t", "term_I_cc", "gm_I_t", "gm_I_cc", "fus_I_f"]
-    for col in num_cols:
-        df[col] = df[col].apply(lambda x: x.replace(
-            ',', '.').strip() if type(x) == str else x).astype(float)
+    for col in _NUMERIC_COLUMNS:
+        raw = df[col]
+        if pd.api.types.is_numeric_dtype(raw):
+            # read_csv already parsed all the values of the column
+            df[col] = raw.astype(float)
+            continue
+        df[col] = _section(raw) if col == "cond_S" else _to_float(raw)
+        invalid = (df[col].isna() & raw.notna()
+                   & (raw.astype(str).str.strip() != ""))
+        if invalid.any():
+            errores.append(pd.DataFrame({"fila": df.index[invalid] + _FIRST_ROW,
+                                         "nombre": df["nombre"][invalid],
+                                         "columna": col,
+                                         "valor": raw[invalid]}))
+    df.attrs["errores"] = (pd.concat(errores).sort_values(["fila", "columna"], kind="stable")
+                           .to_dict("records") if errores else [])
+    df.index = pd.RangeIndex(1, len(df) + 1)
 
     return df
 
 
+def print_errors(df: pd.DataFrame):
+    """
+    Prints the table of invalid values found by parse_data, if any.
+    """
+    errores = df.attrs.get("errores")
+    if errores:
+        errores = pd.DataFrame(errores)
+        print(f"Valores invalidos en {errores['fila'].nunique()} filas:")
+        print(errores.to_string(index=False))
+
+
+def _create_nodes(row) -> tuple:
+    """
+    Creates the Proteccion -> Conductor -> Carga/Barra chain of a row of the
+    DataFrame (a namedtuple from DataFrame.itertuples).
+
+    Returns
+    -------
+    tuple
+        The Proteccion at the top of the chain and the leaf node.
+    """
+    if row.term_curva == 'C' and not pd.isna(row.term_nombre):
+        termica = Termica(name=row.term_nombre, I_t=row.term_I_t,
+                          I_cc=row.term_I_cc, curva='C')
+    elif row.term_curva == 'M' and not pd.isna(row.term_nombre):
+        termica = Termica(name=row.term_nombre, I_t=row.term_I_t,
+                          I_r=row.term_I_r, t_r=row.term_t_r,
+                          I_sd=row.term_I_sd, t_sd=row.term_t_sd,
+                          I_i=row.term_I_i, I_cc=row.term_I_cc, curva='M')
+    elif not pd.isna(row.gm_nombre):
+        termica = Termica(name=row.gm_nombre, I_t=row.I_n,
+                          I_cc=row.gm_I_cc, curva=row.gm_curva)
+    else:
+        termica = None
+
+    protecction = Proteccion(
+        fusible=Fusible(name=row.fus_nombre, I_f=row.fus_I_f) if not pd.isna(
+            row.fus_I_f) else None,
+        termica=termica)
+    cable = Conductor(name=row.cond_nombre, S=row.cond_S,
+                      I_adm=row.cond_I_adm, K=row.cond_K,
+                      I_n=row.I_n)
+    # the short-circuit currents, if they were computed (see cortocircuito)
+    I_cc = getattr(row, "I_cc", 0)
+    I_cc_min = getattr(row, "I_cc_min", 0)
+    if row.es_carga:
+        leaf = Carga(name=row.nombre, I_n=row.I_n, I_cc=I_cc, I_cc_min=I_cc_min)
+    else:
+        leaf = Barra(name=row.nombre, I_cc=I_cc, I_cc_min=I_cc_min)
+    protecction.add_child(cable)
+    cable.add_child(leaf)
+    return protecction, leaf
+
+
+def _feeder_index(nombres: list, alimentadores: list, origenes: list = None) -> list:
+    """
+    Returns, for each row, the position of the row of its feeder, or -1 if it
+    is fed from the network. If the origin of each row is given (see
+    merge_data), the messages say in which sheet the problem is.
+
+    Raises
+    ------
+    ValueError
+        If there are repeated names, feeders that are not in the list of names
+        or feeders that form a cycle. The message lists all of them.
+    """
+    def where(i: int) -> str:
+        return f" ({origenes[i]})" if origenes is not None else ""
+
+    index = {}
+    errors = []
+    for i, nombre in enumerate(nombres):
+        if nombre in index:
+            if origenes is not None and origenes[index[nombre]] != origenes[i]:
+                errors.append(f"Nombre repetido: {nombre} ({origenes[index[nombre]]} y {origenes[i]})")
+            else:
+                errors.append(f"Nombre repetido: {nombre}{where(i)}")
+        index[nombre] = i
+
+    parents = [-1] * len(nombres)
+    for i, alimentador in enumerate(alimentadores):
+        if pd.isna(alimentador):
+            continue
+        if alimentador not in index:
+            errors.append(
+                f"El alimentador {alimentador} de {nombres[i]} no existe{where(i)}")
+        else:
+            parents[i] = index[alimentador]
+
+    # follow each chain of feeders once: 1 = in the current chain, 2 = checked
+    state = [0] * len(nombres)
+    for i in range(len(nombres)):
+        chain = []
+        j = i
+        while j != -1 and state[j] == 0:
+            state[j] = 1
+            chain.append(j)
+            j = parents[j]
+        if j != -1 and state[j] == 1:
+            cycle = chain[chain.index(j):] + [j]
+            errors.append(
+                f"Ciclo de alimentadores: {' -> '.join(str(nombres[k]) for k in cycle)}")
+        for k in chain:
+            state[k] = 2
+
+    if errors:
+        raise ValueError("\n".join(errors))
+    return parents
+
+
+@metricas.timed("create_tree")
 def create_tree(df: pd.DataFrame) -> dict:
     """
     Constructs a hierarchical tree structure based on the provided DataFrame.
 
-    Iterates over each row in the DataFrame to create instances of Termica, 
-    Proteccion, Conductor, Carga, or Barra, and connects them into a tree 
-    structure. The function returns a dictionary mapping item names to their 
-    corresponding leaf nodes within the tree.
+    Iterates once over the rows of the DataFrame to create instances of
+    Termica, Proteccion, Conductor, Carga, or Barra, and then connects each
+    Proteccion to the leaf node of its feeder, found by position. The function
+    returns a dictionary mapping item names to their corresponding leaf nodes
+    within the tree.
 
     Parameters
     ----------
@@ -101,58 +407,464 @@ def create_tree(df: pd.DataFrame) -> dict:
     dict
         A dictionary mapping item names from the DataFrame to their 
         corresponding leaf nodes in the constructed tree.
+
+    Raises
+    ------
+    ValueError
+        If a name is repeated, or a feeder does not exist or is part of a
+        cycle. These are checked before any node is created.
     """
 
-    # Create a dictionary to store the items in the tree
-    items = {}
+    nombres = df["nombre"].tolist()
+    parents = _feeder_index(nombres, df["alimentador"].tolist(),
+                            df["origen"].tolist() if "origen" in df else None)
+
     red = Red()
-    for i, row in df.iterrows():
-        if row["term_curva"] == 'C' and not pd.isna(row["term_nombre"]):
-            termica = Termica(name=row["term_nombre"], I_t=row["term_I_t"],
-                              I_cc=row["term_I_cc"], curva='C')
-        elif row["term_curva"] == 'M' and not pd.isna(row["term_nombre"]):
-            termica = Termica(name=row["term_nombre"], I_t=row["term_I_t"],
-                              I_r=row["term_I_r"], t_r=row["term_t_r"],
-                              I_sd=row["term_I_sd"], t_sd=row["term_t_sd"],
-                              I_i=row["term_I_i"], I_cc=row["term_I_cc"], curva='M')
-        elif not pd.isna(row["gm_nombre"]):
-            termica = Termica(name=row["gm_nombre"], I_t=row["I_n"],
-                              I_cc=row["gm_I_cc"], curva=row["gm_curva"])
-        else:
-            termica = None
-
-        protecction = Proteccion(
-            fusible=Fusible(name=row["fus_nombre"], I_f=row["fus_I_f"]) if not pd.isna(
-                row["fus_I_f"]) else None,
-            termica=termica)
-        cable = Conductor(name=row["cond_nombre"], S=row["cond_S"],
-                          I_adm=row["cond_I_adm"], K=row["cond_K"],
-                          I_n=row["I_n"])
-        if row["es_carga"]:
-            leaf = Carga(name=row["nombre"], I_n=row["I_n"])
-        else:
-            leaf = Barra(name=row["nombre"])
-        protecction.add_child(cable)
-        cable.add_child(leaf)
-        items.update({row["nombre"]: leaf})
+    with paused_gc():
+        nodes = [_create_nodes(row) for row in df.itertuples(index=False)]
+        for (protecction, leaf), parent in zip(nodes, parents):
+            if parent == -1:
+                red.add_child(protecction)
+            else:
+                nodes[parent][1].add_child(protecction)
 
-    # associate each item with its parent
+    return {nombre: leaf for nombre, (protecction, leaf) in zip(nombres, nodes)}
 
-    for i, row in df.iterrows():
-        child = items[row["nombre"]]
-        while not isinstance(child, Proteccion):
-            child = child.parent
-        protecction = child
 
-        if row["alimentador"] not in [None, np.nan]:
-            items[row["alimentador"]].add_child(protecction)
-        else:
-            red.add_child(protecction)
+# Columns read by _create_nodes, a change in any of them replaces the nodes.
+# I_cc and I_cc_min are only there after cortocircuito.short_circuit, a
+# missing one is the default of the nodes (0).
+_NODE_COLUMNS = ['nombre', 'es_carga', 'I_n', 'cond_nombre', 'cond_S', 'cond_I_adm', 'cond_K',
+                 'term_nombre', 'term_I_t', 'term_I_cc', 'term_I_r', 'term_t_r', 'term_I_sd',
+                 'term_t_sd', 'term_I_i', 'term_curva', 'gm_nombre', 'gm_I_cc', 'gm_curva',
+                 'fus_nombre', 'fus_I_f', 'I_cc', 'I_cc_min']
+
+
+def _differ(old: np.ndarray, new: np.ndarray) -> np.ndarray:
+    differ = old != new
+    # NaN != NaN, only the values that differ are checked
+    differ[differ] = ~(pd.isna(old[differ]) & pd.isna(new[differ]))
+    return differ
+
+
+@metricas.timed("patch_tree")
+def patch_tree(items: dict, old: pd.DataFrame, new: pd.DataFrame) -> tuple:
+    """
+    Updates the tree built from the DataFrame old to the DataFrame new,
+    changing only the rows that are different, instead of building the whole
+    tree again with create_tree.
+
+    The rows are matched by nombre. The nodes of the added rows are created,
+    the ones of the removed rows are disconnected, the ones of the rows whose
+    devices changed are replaced (the items they feed are moved to the new
+    node), and the rows with another feeder are connected to it. The rest of
+    the nodes are not touched, so their cached curves and depths are kept.
+    The children of each node follow the order of the rows of new, as in
+    create_tree, also when the rows were only reordered.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree built from old. Its nodes are
+        modified.
+    old : pd.DataFrame
+        DataFrame the tree was built from.
+    new : pd.DataFrame
+        New DataFrame.
+
+    Returns
+    -------
+    tuple
+        The dictionary of items of the new DataFrame, in its order, and a
+        dictionary with the lists of names "agregados", "eliminados",
+        "modificados", "movidos" and "subarboles". The last one has the items
+        whose plot changed that are not fed by another of them: the plots and
+        reports that have to be updated are the ones of those items and of
+        everything they feed.
+
+    Raises
+    ------
+    ValueError
+        Like create_tree, if a name is repeated, or a feeder does not exist or
+        is part of a cycle. These are checked before any node is changed.
+    """
+    # from an empty tree all the rows are added
+    root = tree_root(items)
+    new_names = new["nombre"].values
+    rows = pd.Index(new_names)
+    # row of old of each row of new, -1 for the added ones
+    position = pd.Index(old["nombre"].values).get_indexer(new_names) \
+        if rows.is_unique else np.full(len(rows), -1)
+    common = position != -1
+    old_rows = position[common]
+    added = new_names[~common]
+    removed = np.setdiff1d(np.arange(len(old)), old_rows, assume_unique=True)
+    removed = old["nombre"].values[removed]
+
+    # the columns are compared aligned by name, without building anything
+    changed = np.zeros(len(old_rows), dtype=bool)
+    for column in _NODE_COLUMNS:
+        if column not in old and column not in new:
+            continue
+        old_values = old[column].values if column in old else np.zeros(len(old))
+        new_values = new[column].values if column in new else np.zeros(len(new))
+        changed |= _differ(old_values[old_rows], new_values[common])
+    new_feeders = new["alimentador"].values
+    moved = _differ(old["alimentador"].values[old_rows], new_feeders[common]) & ~changed
+    modified = new_names[common][changed]
+    moved = new_names[common][moved]
+
+    if len(added) or len(removed) or len(moved) or not rows.is_unique:
+        _feeder_index(new_names.tolist(), new_feeders.tolist(),
+                      new["origen"].tolist() if "origen" in new else None)
+
+    # the new nodes are created before changing the tree, if a row fails
+    # the tree is left as it was
+    created = ~common
+    created[common] = changed
+    with paused_gc():
+        chains = {row.nombre: _create_nodes(row)
+                  for row in new[created].itertuples(index=False)}
+
+    # Proteccion at the top of the chain of each leaf
+    def top(nombre):
+        return items[nombre].parent.parent
+
+    for nombre in [*removed, *modified, *moved]:
+        protecction = top(nombre)
+        if protecction.parent is not None:
+            protecction.parent.remove_child(protecction)
+    for nombre in modified:
+        leaf = chains[nombre][1]
+        for child in list(items[nombre].get_children() or []):
+            items[nombre].remove_child(child)
+            leaf.add_child(child)
+
+    new_items = dict(zip(new_names, map(items.get, new_names)))
+    new_items.update((nombre, leaf) for nombre, (protecction, leaf) in chains.items())
+    touched = {}
+    for nombre in [*added, *modified, *moved]:
+        feeder = new_feeders[rows.get_loc(nombre)]
+        parent = root if pd.isna(feeder) else new_items[feeder]
+        parent.add_child(chains[nombre][0] if nombre in chains else top(nombre))
+        touched[id(parent)] = parent
+
+    # the children are kept in the order of the rows, as in create_tree. If
+    # the rows that were kept changed their order, all of them are sorted
+    if np.any(np.diff(old_rows) < 0):
+        touched = {id(nodo): nodo for nodo in [root, *new_items.values()]}
+    for parent in touched.values():
+        children = parent.get_children()
+        if children:
+            order = rows.get_indexer([protecction.child.child.name for protecction in children])
+            children[:] = [children[i] for i in np.argsort(order, kind="stable")]
+
+    # the changed items that are not fed by another changed item
+    changes = set(added) | set(modified) | set(moved)
+    subtrees = []
+    for nombre in changes:
+        nodo = new_items[nombre].parent
+        while nodo is not None and not (isinstance(nodo, (Barra, Carga)) and nodo.name in changes):
+            nodo = nodo.parent
+        if nodo is None:
+            subtrees.append(nombre)
+    subtrees.sort(key=rows.get_loc)
+    return new_items, {"agregados": list(added), "eliminados": list(removed),
+                       "modificados": list(modified), "movidos": list(moved),
+                       "subarboles": subtrees}
+
+
+# Snapshot of the last tree, reused while the DataFrame does not change
+_TREE_PATH = "./cache/arbol.pkl"
+
+
+def _tree_key(df: pd.DataFrame) -> str:
+    """
+    SHA-1 of the content of the DataFrame and of the fields of the classes of
+    the tree (see clases.tree_schema), the key of the snapshot of its tree.
+    A snapshot saved before a change in the fields is not loaded.
+    """
+    sha1 = hashlib.sha1(repr(tree_schema()).encode())
+    sha1.update(repr(list(df.columns)).encode())
+    sha1.update(pd.util.hash_pandas_object(df).values)
+    return sha1.hexdigest()
+
+
+def save_tree(items: dict, path: str, key: str = None):
+    """
+    Saves a snapshot of the tree as flat arrays (see clases.tree_to_arrays),
+    which is loaded faster than the tree is built again from the DataFrame.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree, as returned by create_tree.
+    path : str
+        File of the snapshot.
+    key : str, optional
+        Identifies the data of the tree, load_tree only returns the snapshot
+        if it is called with the same key.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with paused_gc():
+        nodes, parents = flatten_tree(tree_root(items))
+        position = {id(nodo): i for i, nodo in enumerate(nodes)}
+        data = tree_to_arrays(nodes, parents)
+        data.update(clave=key, nombres=list(items),
+                    posiciones=[position[id(nodo)] for nodo in items.values()])
+        with open(path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+@metricas.timed("load_tree")
+def load_tree(path: str, key: str = None) -> dict:
+    """
+    Loads a snapshot saved with save_tree. Returns the dictionary of items,
+    or None if there is no snapshot, it was saved with another key or it
+    cannot be read (for example, saved by an older version of the classes).
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f, paused_gc():
+            data = pickle.load(f)
+        if key is not None and data["clave"] != key:
+            return None
+        nodes = tree_from_arrays(data)
+    except Exception:
+        return None
+    return {nombre: nodes[i] for nombre, i in zip(data["nombres"], data["posiciones"])}
 
+
+def get_tree(df: pd.DataFrame, cache: bool = True) -> dict:
+    """
+    Returns the tree of the DataFrame, like create_tree. If cache is True (the
+    default), the tree is loaded from the snapshot in the "cache" folder when
+    it was saved from the same data, and saved there otherwise.
+    """
+    if not cache:
+        return create_tree(df)
+    key = _tree_key(df)
+    items = load_tree(_TREE_PATH, key)
+    if items is None:
+        items = create_tree(df)
+        save_tree(items, _TREE_PATH, key)
     return items
 
 
-def create_all_plots(df: pd.DataFrame, items: dict):
+def tree_table(root: Nodo, max_depth: int = None) -> pd.DataFrame:
+    """
+    Returns the tree from root as an edge list, one row per node in preorder
+    with its position (id), the position of its parent (padre, -1 for root),
+    its type (tipo), its name (nombre) and its parameters. The parameters of
+    the Fusible and Termica of a Proteccion have the prefixes fusible_ and
+    termica_, and the ones that a node does not have are left empty.
+
+    The columns are filled by type of node, not node by node, so it takes
+    linear time also for networks of hundreds of thousands of nodes.
+
+    With max_depth only that number of levels of buses/loads from root are
+    kept, like in Nodo.write_tree, and the positions are renumbered.
+    """
+    nodes, parents = flatten_tree(root)
+    if max_depth is not None:
+        # buses/loads above each node, parents come before their children
+        above = [0] * len(nodes)
+        leaf = [isinstance(nodo, (Barra, Carga)) for nodo in nodes]
+        for i, parent in enumerate(parents.tolist()):
+            if parent != -1:
+                above[i] = above[parent] + leaf[parent]
+        keep = np.array(above) < max_depth
+        position = np.cumsum(keep) - 1
+        parents = np.where(parents[keep] == -1, -1, position[parents[keep]])
+        nodes = [nodo for nodo, kept in zip(nodes, keep.tolist()) if kept]
+    length = len(nodes)
+    types = [type(nodo) for nodo in nodes]
+    groups = {}
+    for i, cls in enumerate(types):
+        groups.setdefault(cls, []).append(i)
+    columns = {"id": np.arange(length), "padre": parents,
+               "tipo": [cls.__name__ for cls in types], "nombre": [nodo.name for nodo in nodes]}
+
+    def put(column: str, positions: np.ndarray, values: list):
+        if column not in columns:
+            columns[column] = np.full(length, None, dtype=object)
+        columns[column][positions] = values
+
+    for cls, positions in groups.items():
+        group = [nodes[i] for i in positions]
+        positions = np.array(positions, dtype=np.int64)
+        for f in fields(cls):
+            if not f.compare or f.name in ("name", "parent", "child", "children"):
+                continue
+            values = [getattr(nodo, f.name) for nodo in group]
+            devices = [value for value in values if value is not None]
+            if not devices or not is_dataclass(devices[0]):
+                put(f.name, positions, values)
+                continue
+            # a device of a Proteccion, one column for each of its fields
+            present = positions[[value is not None for value in values]]
+            for device_field in fields(devices[0]):
+                if device_field.compare:
+                    name = "nombre" if device_field.name == "name" else device_field.name
+                    put(f"{f.name}_{name}", present,
+                        [getattr(device, device_field.name) for device in devices])
+    return pd.DataFrame(columns).infer_objects()
+
+
+def export_tree(root: Nodo, path: str, max_depth: int = None):
+    """
+    Saves the tree from root as an edge list (see tree_table), as JSON if the
+    path ends with .json, as CSV otherwise.
+    """
+    table = tree_table(root, max_depth)
+    if path.lower().endswith(".json"):
+        table.to_json(path, orient="records", indent=2, force_ascii=False)
+    else:
+        table.to_csv(path, index=False)
+
+
+# Settings passed to savefig, they are part of the hash of each plot
+_PLOT_SETTINGS = dict(bbox_inches='tight')
+
+
+def _plot_settings(formato: str = "png", dpi: float = None, tight: bool = True) -> dict:
+    """
+    Returns the settings passed to savefig for the plots saved as files. The
+    default ones are _PLOT_SETTINGS, so the hashes of the plots already saved
+    stay valid.
+    """
+    settings = dict(_PLOT_SETTINGS) if tight else {}
+    if dpi is not None:
+        settings["dpi"] = dpi
+    if formato != "png":
+        settings["format"] = formato
+    return settings
+
+
+def _plot_path(name: str, formato: str = "png") -> str:
+    return f"./curvas/current-time_characteristic_{name}.{formato}"
+
+
+def _hash_path(name: str, formato: str = "png") -> str:
+    return _plot_path(name, formato) + ".sha1"
+
+
+def _plot_hash(items: dict, name: str, settings: dict = _PLOT_SETTINGS) -> str:
+    return items[name].plot_hash(catalogo=CATALOGO_FUSIBLES.version, **settings)
+
+
+def _is_up_to_date(items: dict, name: str, settings: dict = _PLOT_SETTINGS) -> bool:
+    """
+    Returns True if the file of the item exists and was rendered from the
+    same protection path and settings as the current tree.
+    """
+    formato = settings.get("format", "png")
+    hash_path = _hash_path(name, formato)
+    if not os.path.exists(_plot_path(name, formato)) or not os.path.exists(hash_path):
+        return False
+    with open(hash_path, "r") as f:
+        return f.read().strip() == _plot_hash(items, name, settings)
+
+
+# Figure reused by all the plots rendered in this process
+_template = None
+
+
+def _render(items: dict, name: str, output, reuse_figure: bool = True, **settings):
+    """
+    Renders the plot of the item with the given name and saves it to output,
+    a path or a file-like object, with the given savefig settings.
+    """
+    global _template
+    from matplotlib import pyplot as plt
+    with metricas.stage("figura", item=name):
+        with metricas.stage("add_plot"):
+            if reuse_figure:
+                if _template is None:
+                    _template = PlotTemplate()
+                fig = _template.create_plot(items[name])
+            else:
+                fig = items[name].create_plot()
+        with metricas.stage("savefig"):
+            fig.get_figure().savefig(output, **settings)
+        if not reuse_figure:
+            plt.close(fig)
+
+
+def _save_plot(items: dict, name: str, reuse_figure: bool = True,
+               settings: dict = _PLOT_SETTINGS):
+    """
+    Renders the plot of the item with the given name and saves it as a file
+    in the "curvas" folder, next to the hash of its protection path.
+    """
+    formato = settings.get("format", "png")
+    _render(items, name, _plot_path(name, formato), reuse_figure, **settings)
+    with open(_hash_path(name, formato), "w") as f:
+        f.write(_plot_hash(items, name, settings))
+
+
+def render_plot(items: dict, name: str, formato: str = "png") -> bytes:
+    """
+    Renders the plot of the item with the given name in memory, in any
+    format supported by savefig ("png", "svg", "pdf"...).
+    """
+    output = io.BytesIO()
+    _render(items, name, output, **dict(_PLOT_SETTINGS, format=formato))
+    return output.getvalue()
+
+
+# Items of the tree built inside each worker process of the pool
+_worker_items = None
+
+
+def _init_worker(df: pd.DataFrame, memoria: bool = None, perfil: str = None):
+    """
+    Initializes a worker process: selects the headless backend and builds its
+    own copy of the tree, so the nodes do not have to be sent with each task.
+    If memoria is not None the worker records its own metricas, with or
+    without tracing the memory, and profiles the stage perfil.
+    """
+    global _worker_items
+    from matplotlib import pyplot as plt
+    plt.switch_backend("Agg")
+    # a forked worker inherits the Metricas of the main process
+    metricas.stop()
+    if memoria is not None:
+        metricas.start(memoria=memoria, perfil=perfil)
+    _worker_items = create_tree(df)
+
+
+def _render_worker(name: str, reuse_figure: bool = True,
+                   settings: dict = _PLOT_SETTINGS) -> tuple:
+    """
+    Renders one item inside a worker process. Returns the error message if the
+    plot could not be created (None otherwise), and the metricas recorded by
+    the worker since its last task (None if they are off).
+    """
+    error = None
+    try:
+        _save_plot(_worker_items, name, reuse_figure, settings)
+    except Exception as e:
+        error = str(e)
+    measures = metricas.current()
+    return error, measures.export() if measures is not None else None
+
+
+def _render_plot_worker(name: str, formato: str = "png") -> bytes:
+    """
+    Renders one item in memory inside a worker process (see render_plot).
+    """
+    return render_plot(_worker_items, name, formato)
+
+
+@metricas.timed("create_all_plots")
+def create_all_plots(df: pd.DataFrame, items: dict, workers: int = 1,
+                     incremental: bool = True, reuse_figure: bool = True,
+                     names: list = None, formato: str = "png", dpi: float = None,
+                     tight: bool = True) -> int:
     """
     Creates a plot for each item in the items dictionary.
 
@@ -162,17 +874,51 @@ def create_all_plots(df: pd.DataFrame, items: dict):
         DataFrame with the data of the items.
     items : dict
         Dictionary with the items to plot.
+    workers : int, optional
+        Number of processes used to render the plots. With 1 (the default)
+        the plots are rendered one at a time in the current process.
+    incremental : bool, optional
+        If True (the default), the plots whose protection path did not change
+        since they were saved are not rendered again.
+    reuse_figure : bool, optional
+        If True (the default), each process draws all its plots on the same
+        figure (see PlotTemplate) instead of creating one figure per plot.
+        The saved images are the same.
+    names : list, optional
+        Names of the items to plot, in order. By default all the items of the
+        DataFrame are plotted.
+    formato : str, optional
+        Format of the files, "png" (the default), "svg" or "pdf".
+    dpi : float, optional
+        Resolution of the images, by default the one of matplotlib (100).
+    tight : bool, optional
+        If True (the default), the margins of each figure are trimmed. It is
+        faster to save the whole figure (False), since the trim draws it twice.
+
+    Returns
+    -------
+    int
+        Number of plots that could not be created.
 
     Notes
     -----
     The method creates a folder called "curvas" in the current directory, and
-    stores the plots in there.
+    stores the plots in there. To get all the plots in one PDF file instead,
+    see atlas.write_atlas.
 
     The method sorts the DataFrame by index, and then iterates over it. For each
     row, it creates a plot using the create_plot method of the item, and saves it
-    as a PNG file in the "curvas" folder.
+    as a file in the "curvas" folder. Next to each file, a file with the same
+    name and the extension .sha1 added stores the hash of the item and its
+    ancestors (see Nodo.plot_hash), which is compared on the next run to skip
+    the plots that did not change. Each format has its own hash.
 
-    If an exception occurs while creating a plot, it is printed to the console.
+    When more than one worker is used, each process builds its own tree from
+    the DataFrame and renders with the Agg backend. The progress is printed as
+    the plots are finished, so the order may differ from the DataFrame.
+
+    If an exception occurs while creating a plot, it is printed to the console,
+    and recorded in the metricas of the run when they are on.
     """
 
     # create folder to store the plots
@@ -181,16 +927,60 @@ def create_all_plots(df: pd.DataFrame, items: dict):
 
     # plot the curves
     df.sort_index(inplace=True)
-    length = df.shape[0]
-    for i, row in df.iterrows():
+    if names is None:
+        names = df["nombre"].tolist()
+    length = len(names)
+    errors = 0
+    settings = _plot_settings(formato, dpi, tight)
+    if workers is not None and workers > 1:
+        pending = []
+        done = 0
+        for name in names:
+            try:
+                if incremental and _is_up_to_date(items, name, settings):
+                    done += 1
+                    print(
+                        f"fig {done}/{length} - {name} - {done*100/length:.1f}% (sin cambios)")
+                    continue
+            except Exception as e:
+                print(e)
+                metricas.record_error("create_all_plots", name, e)
+                errors += 1
+                continue
+            pending.append(name)
+
+        measures = metricas.current()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(df, measures and measures.memoria,
+                                           measures and measures.perfil)) as pool:
+            futures = {pool.submit(_render_worker, name, reuse_figure, settings): name
+                       for name in pending}
+            for i, future in enumerate(as_completed(futures), start=done + 1):
+                error, worker_measures = future.result()
+                if worker_measures is not None:
+                    measures.merge(worker_measures)
+                if error is None:
+                    print(
+                        f"fig {i}/{length} - {futures[future]} - {i*100/length:.1f}%")
+                else:
+                    print(error)
+                    metricas.record_error("create_all_plots", futures[future], error)
+                    errors += 1
+        return errors
+
+    for i, name in enumerate(names, start=1):
         try:
-            fig = items[row["nombre"]].create_plot()
-            fig.get_figure().savefig(
-                f"./curvas/current-time_characteristic_{row['nombre']}.png", bbox_inches='tight')
-            print(f"fig {i}/{length} - {row['nombre']} - {i*100/length:.1f}%")
-            plt.close(fig)
+            if incremental and _is_up_to_date(items, name, settings):
+                print(
+                    f"fig {i}/{length} - {name} - {i*100/length:.1f}% (sin cambios)")
+                continue
+            _save_plot(items, name, reuse_figure, settings)
+            print(f"fig {i}/{length} - {name} - {i*100/length:.1f}%")
         except Exception as e:
             print(e)
+            metricas.record_error("create_all_plots", name, e)
+            errors += 1
+    return errors
 
 
 def create_plot(items: dict, name: str, show: bool = False):
@@ -218,33 +1008,48 @@ def create_plot(items: dict, name: str, show: bool = False):
         os.mkdir("./curvas")
 
     # plot the curve
+    from matplotlib import pyplot as plt
     try:
-        fig = items[name].create_plot()
-        fig.get_figure().savefig(
-            f"./curvas/current-time_characteristic_{name}.png", bbox_inches='tight')
+        with metricas.stage("figura", item=name):
+            with metricas.stage("add_plot"):
+                fig = items[name].create_plot()
+            with metricas.stage("savefig"):
+                fig.get_figure().savefig(
+                    f"./curvas/current-time_characteristic_{name}.png", bbox_inches='tight')
         if show:
             fig.show()
             input("Presione enter para continuar...")
         plt.close(fig)
     except Exception as e:
         print(e)
+        metricas.record_error("create_plot", name, e)
 
 
-def run():
+def run(url=None):
     print('Cargando datos...')
-    url = get_url()
-    df = get_data(url)
-    items = create_tree(df)
+    if url is None:
+        urls = get_urls()
+    else:
+        urls = [url] if isinstance(url, str) else list(url)
+    # the data saved in the cache is used until it is refreshed (option 3)
+    df = get_data_multiple(urls, refresh=False)
+    print_errors(df)
+    items = get_tree(df)
+    # index for the selections of options 4 and 6, built when first used
+    indice = None
     while True:
         response = input("""MENU
 1. Crear todas las graficas
 2. Crear una grafica
 3. Refrescar datos
 4. Crear varias graficas
+5. Reporte de selectividad
+6. Graficar una barra y todo lo que alimenta
+7. Crear un PDF con todas las graficas
 9. Salir
 """)
         if response == '1':
-            create_all_plots(df, items)
+            create_all_plots(df, items, workers=os.cpu_count())
         elif response == '2':
             name = input(
                 "Nombre de la barra/carga a graficar: ")
@@ -256,26 +1061,356 @@ def run():
                 create_plot(items, name, show=True)
         elif response == '3':
             print('Cargando datos...')
-            df = get_data(url)
-            items = create_tree(df)
+            new_df = get_data_multiple(urls)
+            if new_df is df:
+                print("Los datos no cambiaron")
+            else:
+                print_errors(new_df)
+                # only the rows that changed are updated in the tree
+                items, cambios = patch_tree(items, df, new_df)
+                df = new_df
+                indice = None
+                print(f"{len(cambios['agregados'])} agregadas, "
+                      f"{len(cambios['eliminados'])} eliminadas, "
+                      f"{len(cambios['modificados'])} modificadas, "
+                      f"{len(cambios['movidos'])} con otro alimentador")
+                subarboles = cambios["subarboles"]
+                if subarboles:
+                    print("Cambiaron las graficas de "
+                          + ", ".join(str(nombre) for nombre in subarboles[:10])
+                          + (f" (y {len(subarboles) - 10} mas)" if len(subarboles) > 10 else "")
+                          + " y de lo que alimentan")
         elif response == '4':
             name = input(
-                "Graficar barras/cargas que comiencen con: ")
+                "Graficar barras/cargas que comiencen con (o patron, como TS5.*): ")
+            if name == '':
+                return
+            if indice is None:
+                indice = Indice(items, df)
+            # without wildcards it is a prefix
+            cargas = indice.select(glob=name if any(c in name for c in "*?[") else name + "*")
+            if not cargas:
+                print("No hay barras/cargas que coincidan")
+            else:
+                create_all_plots(df, items, names=cargas)
+        elif response == '5':
+            path = input(
+                "Archivo del reporte (.csv o .json) [reporte_selectividad.csv]: ")
+            report = analyze_selectivity(items)
+            save_report(report, path or "reporte_selectividad.csv")
+            print(f"{(~report['selectivo']).sum()} protecciones no selectivas, "
+                  f"{(~report['conductor_protegido']).sum()} conductores desprotegidos")
+        elif response == '6':
+            name = input(
+                "Barra desde la que graficar todo lo que alimenta: ")
             if name == '':
                 return
             if name not in items:
                 print("La barra/carga no existe")
             else:
-                cargas = [item for item in items if item.startswith(name)]
-                length = len(cargas)
-                for i, name in enumerate(cargas):
-                    create_plot(items, name)
-                    print(f"fig {i+1}/{length} - {name} - {(i+1)*100/length:.1f}%")
+                if indice is None:
+                    indice = Indice(items, df)
+                create_all_plots(df, items, names=indice.select(subtree=name))
+        elif response == '7':
+            from atlas import write_atlas
+            path = input("Archivo PDF [curvas.pdf]: ")
+            write_atlas(items, path or "curvas.pdf", names=df.sort_index()["nombre"].tolist())
         elif response == '9':
             return
         else:
             print("Respuesta invalida")
 
 
+def _load(args) -> tuple:
+    """
+    Loads the DataFrame and the tree for the subcommands of main.
+    """
+    urls = args.source if args.source else get_urls()
+    df = get_data_multiple(urls, refresh=not args.offline)
+    print_errors(df)
+    items = get_tree(df)
+    if args.icc is not None:
+        from cortocircuito import short_circuit
+        longitudes = None
+        if args.lengths is not None:
+            longitudes = pd.read_csv(args.lengths).set_index("nombre")["longitud"]
+        df = short_circuit(df, items, I_cc=args.icc, longitudes=longitudes)
+    return df, items
+
+
+def main(argv: list = None) -> int:
+    """
+    Entry point of the command line. Without a subcommand it runs the
+    interactive menu.
+
+    Subcommands
+    -----------
+    render --all | [--prefix P] [--glob G] [--regex R] [--sector S] [--emergencia si|no] [--subtree BUS]
+        Creates the plots in the "curvas" folder with the Agg backend, of all
+        the items or of the ones that meet all the filters (see
+        seleccion.Indice). --format, --dpi and --no-tight change the files,
+        and --atlas FILE [--grid 2x2] saves all the plots in one PDF instead
+        (see atlas.write_atlas).
+    report [--output FILE]
+        Saves the selectivity report (CSV or JSON).
+    faults [--output FILE]
+        Saves the short-circuit currents of each item and the breakers with
+        a breaking capacity below them (see cortocircuito.short_circuit).
+    i2t [--output FILE]
+        Saves the let-through energy check of the conductors (see
+        selectividad.analyze_let_through).
+    optimize [--output FILE] [--workers N] [--margin S]
+        Proposes settings for the M curve breakers and saves them (CSV or
+        JSON, see optimizador.optimize_settings).
+    tree [NAME] [--depth N] [--output FILE]
+        Prints the single-line tree of the network or of an item, or saves it
+        as text, or as a CSV/JSON edge list (see export_tree).
+    serve [--port PORT]
+        Serves the curves over HTTP (see visor.VisorCurvas).
+    menu
+        Runs the interactive menu.
+
+    With --icc A (and --lengths FILE) the short-circuit currents are computed
+    before running the subcommand, and the plots show them.
+
+    With --metrics FILE the time and memory of each stage are saved as JSON
+    (see metricas.Metricas), and --profile STAGE runs that stage with cProfile.
+
+    matplotlib is only imported by the subcommands that plot.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Graficador de curvas intensidad-tiempo de un unifilar")
+    parser.add_argument("--source", action="append",
+                        help="url o archivo CSV/XLSX con los datos (por defecto los de google_sheets_name.txt), "
+                             "se puede repetir para unir varias hojas")
+    parser.add_argument("--offline", action="store_true",
+                        help="usar los datos guardados en ./cache sin volver a leer la hoja")
+    parser.add_argument("--icc", type=float, metavar="A",
+                        help="corriente de cortocircuito en las barras alimentadas desde la red, "
+                             "para calcular la de todas las barras/cargas")
+    parser.add_argument("--lengths", metavar="ARCHIVO",
+                        help="CSV con las columnas nombre y longitud (m) del conductor de "
+                             "cada barra/carga, para --icc")
+    parser.add_argument("--metrics", metavar="ARCHIVO",
+                        help="guardar el tiempo de cada etapa en un JSON")
+    parser.add_argument("--profile", metavar="ETAPA",
+                        help="ejecutar la etapa (p. ej. create_tree o savefig) con cProfile, "
+                             "implica --metrics metricas.json si no se indica otro archivo")
+    parser.add_argument("--memory", action="store_true",
+                        help="medir tambien el pico de memoria de cada etapa con tracemalloc, "
+                             "que hace mucho mas lento savefig; implica --metrics como --profile")
+    subparsers = parser.add_subparsers(dest="command")
+
+    render = subparsers.add_parser(
+        "render", help="crear las graficas",
+        description="Con varios filtros se grafican las barras/cargas que cumplen todos.")
+    render.add_argument("--all", action="store_true",
+                        help="graficar todas las barras/cargas")
+    render.add_argument("--prefix",
+                        help="graficar las barras/cargas que comienzan con PREFIX")
+    render.add_argument("--glob",
+                        help="graficar las barras/cargas que coinciden con un patron, como 'TS5.*'")
+    render.add_argument("--regex",
+                        help="graficar las barras/cargas que contienen la expresion regular")
+    render.add_argument("--sector", help="graficar las barras/cargas del sector")
+    render.add_argument("--emergencia", choices=["si", "no"],
+                        help="graficar solo las cargas de emergencia (si) o las normales (no)")
+    render.add_argument("--subtree", metavar="BARRA",
+                        help="graficar la barra y todo lo que alimenta")
+    render.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="cantidad de procesos (por defecto uno por CPU)")
+    render.add_argument("--force", action="store_true",
+                        help="volver a crear las graficas que no cambiaron")
+    render.add_argument("--format", choices=["png", "svg", "pdf"], default="png",
+                        help="formato de los archivos (por defecto png)")
+    render.add_argument("--dpi", type=float,
+                        help="resolucion de las imagenes (por defecto 100)")
+    render.add_argument("--no-tight", action="store_true",
+                        help="no recortar los margenes de cada figura (es mas rapido)")
+    render.add_argument("--atlas", metavar="ARCHIVO",
+                        help="guardar todas las graficas en un solo PDF con indice "
+                             "(o una imagen por pagina si no es .pdf)")
+    render.add_argument("--grid", default="1x1", metavar="FILASxCOLUMNAS",
+                        help="graficas por pagina de --atlas (por defecto 1x1)")
+
+    report = subparsers.add_parser("report", help="reporte de selectividad")
+    report.add_argument("--output", "-o", default="reporte_selectividad.csv",
+                        help="archivo .csv o .json (por defecto reporte_selectividad.csv)")
+
+    faults = subparsers.add_parser("faults", help="corrientes de cortocircuito (requiere --icc)")
+    faults.add_argument("--output", "-o", default="cortocircuito.csv",
+                        help="archivo .csv o .json (por defecto cortocircuito.csv)")
+
+    i2t = subparsers.add_parser("i2t", help="verificar la energia I²t de los conductores "
+                                            "(requiere --icc)")
+    i2t.add_argument("--output", "-o", default="i2t.csv",
+                     help="archivo .csv o .json (por defecto i2t.csv)")
+
+    optimize = subparsers.add_parser("optimize", help="proponer ajustes de las termicas de curva M")
+    optimize.add_argument("--output", "-o", default="ajustes.csv",
+                          help="archivo .csv o .json (por defecto ajustes.csv)")
+    optimize.add_argument("--workers", type=int, default=os.cpu_count(),
+                          help="cantidad de procesos (por defecto uno por CPU)")
+    optimize.add_argument("--margin", type=float, default=0.1,
+                          help="margen de tiempo de selectividad en segundos (por defecto 0.1)")
+    optimize.add_argument("--data-output", metavar="ARCHIVO",
+                          help="guardar tambien los datos con los ajustes propuestos, "
+                               "en un .csv o .json con las columnas de get_data")
+
+    tree = subparsers.add_parser("tree", help="mostrar el arbol del unifilar")
+    tree.add_argument("name", nargs="?",
+                      help="barra/carga a mostrar (por defecto toda la red)")
+    tree.add_argument("--depth", type=int,
+                      help="cantidad de niveles de barras/cargas a mostrar")
+    tree.add_argument("--output", "-o",
+                      help="guardar el arbol en un archivo: .csv o .json como lista de "
+                           "aristas con los parametros de cada nodo, texto en otro caso")
+
+    serve = subparsers.add_parser("serve", help="servir las curvas por HTTP")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="direccion (por defecto 127.0.0.1, 0.0.0.0 para toda la red)")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=os.cpu_count(),
+                       help="cantidad de procesos que grafican (por defecto uno por CPU)")
+    serve.add_argument("--cache-size", type=int, default=512,
+                       help="cantidad maxima de imagenes guardadas en memoria")
+
+    subparsers.add_parser("menu", help="menu interactivo")
+
+    args = parser.parse_args(argv)
+    if args.command in ("faults", "i2t") and args.icc is None:
+        parser.error(f"{args.command}: indicar la corriente de cortocircuito de la red con --icc")
+    if args.command == "render":
+        try:
+            args.grid = tuple(int(value) for value in args.grid.lower().split("x"))
+        except ValueError:
+            args.grid = ()
+        if len(args.grid) != 2 or min(args.grid) < 1:
+            render.error("--grid debe ser FILASxCOLUMNAS, como 2x2")
+        filters = [args.prefix, args.glob, args.regex, args.sector, args.emergencia,
+                   args.subtree]
+        if args.all == any(value is not None for value in filters):
+            render.error("indicar --all o al menos un filtro (--prefix, --glob, --regex, "
+                         "--sector, --emergencia, --subtree), pero no ambos")
+    if (args.profile or args.memory) and not args.metrics:
+        args.metrics = "metricas.json"
+    if not args.metrics:
+        return _command(args)
+    measures = metricas.start(memoria=args.memory, perfil=args.profile)
+    try:
+        return _command(args)
+    finally:
+        metricas.stop()
+        measures.save(args.metrics)
+        print(f"Metricas guardadas en {args.metrics}", file=sys.stderr)
+
+
+def _command(args) -> int:
+    """
+    Runs the subcommand parsed by main.
+    """
+    if args.command in (None, "menu"):
+        run(args.source)
+        return 0
+
+    # headless: no window is ever opened by the subcommands
+    os.environ["MPLBACKEND"] = "Agg"
+    print('Cargando datos...', file=sys.stderr)
+
+    if args.command == "serve":
+        from visor import VisorCurvas
+        visor = VisorCurvas(args.source if args.source else get_urls(), host=args.host,
+                            port=args.port, workers=args.workers,
+                            cache_size=args.cache_size, refresh=not args.offline)
+        print(f"Sirviendo las curvas en {visor.url}", file=sys.stderr)
+        try:
+            visor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    df, items = _load(args)
+
+    if args.command == "render":
+        names = None
+        if not args.all:
+            if args.subtree is not None and args.subtree not in items:
+                print("La barra/carga no existe", file=sys.stderr)
+                return 1
+            names = Indice(items, df).select(
+                prefix=args.prefix, glob=args.glob, regex=args.regex, sector=args.sector,
+                es_emergencia=None if args.emergencia is None else args.emergencia == "si",
+                subtree=args.subtree)
+            if not names:
+                print("No hay barras/cargas que coincidan", file=sys.stderr)
+                return 1
+        if args.atlas is not None:
+            from atlas import write_atlas
+            if names is None:
+                names = df.sort_index()["nombre"].tolist()
+            errors = write_atlas(items, args.atlas, names=names, grid=args.grid, dpi=args.dpi)
+            return 1 if errors else 0
+        errors = create_all_plots(df, items, workers=args.workers,
+                                  incremental=not args.force, names=names,
+                                  formato=args.format, dpi=args.dpi, tight=not args.no_tight)
+        return 1 if errors else 0
+
+    if args.command == "report":
+        report = analyze_selectivity(items)
+        save_report(report, args.output)
+        print(f"{(~report['selectivo']).sum()} protecciones no selectivas, "
+              f"{(~report['conductor_protegido']).sum()} conductores desprotegidos")
+        return 0
+
+    if args.command == "faults":
+        report = pd.DataFrame(df.attrs["cortocircuito"])
+        save_report(report, args.output)
+        if report.empty:
+            print("No hay barras/cargas")
+            return 0
+        print(f"{report['corte_insuficiente'].sum()} termicas con poder de corte insuficiente")
+        return 0
+
+    if args.command == "i2t":
+        report = analyze_let_through(items)
+        save_report(report, args.output)
+        print(f"{(report['verificado'] & ~report['cumple']).sum()} conductores sin proteger "
+              f"contra cortocircuito, {(~report['verificado']).sum()} sin verificar")
+        return 0
+
+    if args.command == "optimize":
+        from optimizador import optimize_settings
+        optimized = optimize_settings(df, items, margen=args.margin, workers=args.workers)
+        report = pd.DataFrame(optimized.attrs["ajustes"])
+        save_report(report, args.output)
+        if args.data_output is not None:
+            save_report(optimized, args.data_output)
+        if report.empty:
+            print("No hay termicas de curva M")
+            return 0
+        print(f"{(report['violaciones'] < report['violaciones_antes']).sum()} de {len(report)} "
+              f"termicas mejoradas, {(~report['factible']).sum()} sin ajuste selectivo, "
+              f"{(~report['ajustes_validos']).sum()} con ajustes desordenados")
+        return 0
+
+    if args.command == "tree":
+        if args.name is None:
+            nodo = tree_root(items)
+        elif args.name not in items:
+            print("La barra/carga no existe", file=sys.stderr)
+            return 1
+        else:
+            nodo = items[args.name]
+        if args.output is None:
+            nodo.write_tree(sys.stdout, args.depth)
+        elif args.output.lower().endswith((".csv", ".json")):
+            export_tree(nodo, args.output, args.depth)
+        else:
+            with open(args.output, "w", encoding="utf-8") as f:
+                nodo.write_tree(f, args.depth)
+        return 0
+
+
 if __name__ == "__main__":
-    run()
+    sys.exit(main())
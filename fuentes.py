@@ -0,0 +1,259 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import pandas as pd
+
+import metricas
+
+
+class Fuente:
+    """
+    Origin of the data of the single-line diagram.
+
+    Subclasses implement read, which returns the raw bytes of the sheet, or
+    None if they did not change since the read described by meta.
+    """
+    formato = "csv"
+
+    def __init__(self, location: str):
+        self.location = location
+
+    @property
+    def key(self) -> str:
+        """
+        Name used for the files of this source in the cache.
+        """
+        return hashlib.sha1(self.location.encode()).hexdigest()[:16]
+
+    def read(self, meta: dict) -> bytes:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.location!r})"
+
+
+class FuenteArchivo(Fuente):
+    """
+    Local CSV or XLSX file with the same layout as the Google Sheets export.
+    Reading XLSX files requires openpyxl.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(os.path.abspath(path))
+        if os.path.splitext(path)[1].lower() in (".xlsx", ".xlsm", ".xls"):
+            self.formato = "xlsx"
+
+    def read(self, meta: dict) -> bytes:
+        stat = os.stat(self.location)
+        if meta.get("mtime") == stat.st_mtime_ns and meta.get("size") == stat.st_size:
+            return None
+        with open(self.location, "rb") as f:
+            data = f.read()
+        meta.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+        return data
+
+
+class FuenteURL(Fuente):
+    """
+    CSV served over HTTP, like the Google Sheets export or a ServidorLocal.
+    The ETag and Last-Modified headers of the last download are sent back, so
+    a server that supports them can answer that nothing changed.
+    """
+
+    def __init__(self, url: str, timeout: float = 60):
+        super().__init__(url)
+        self.timeout = timeout
+
+    def read(self, meta: dict) -> bytes:
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        request = urllib.request.Request(self.location, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = response.read()
+                meta.update(etag=response.headers.get("ETag"),
+                            last_modified=response.headers.get("Last-Modified"))
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        return data
+
+
+def create_source(location: str) -> Fuente:
+    """
+    Returns a FuenteURL for http(s) urls and a FuenteArchivo otherwise.
+    """
+    if location.startswith(("http://", "https://")):
+        return FuenteURL(location)
+    return FuenteArchivo(location)
+
+
+class CacheFuente:
+    """
+    Keeps the parsed DataFrame of a source in memory and in a pickle file on
+    disk, next to a JSON file with the SHA-1 of the raw data and the metadata
+    used for the conditional reads.
+
+    Parameters
+    ----------
+    fuente : Fuente
+        Source of the data.
+    parse : callable
+        Function that receives the raw bytes (as a file-like object) and the
+        format of the source, and returns the clean DataFrame.
+    directorio : str, optional
+        Folder of the cache files. The default is "./cache".
+    version : int, optional
+        Version of the output of parse. The cached DataFrames saved with
+        another version are parsed again, even if the data did not change.
+    """
+
+    def __init__(self, fuente: Fuente, parse, directorio: str = "./cache", version: int = 0):
+        self.fuente = fuente
+        self.parse = parse
+        self.directorio = directorio
+        self.version = version
+        self.df = None
+        self.meta = {}
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.directorio, f"{self.fuente.key}.json")
+
+    @property
+    def _data_path(self) -> str:
+        return os.path.join(self.directorio, f"{self.fuente.key}.pkl")
+
+    def _load_disk(self) -> bool:
+        if self.df is not None:
+            return True
+        if not (os.path.exists(self._meta_path) and os.path.exists(self._data_path)):
+            return False
+        with open(self._meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("version", 0) != self.version:
+            return False
+        self.meta = meta
+        with metricas.stage("cache"):
+            self.df = pd.read_pickle(self._data_path)
+        return True
+
+    def _save_disk(self):
+        if not os.path.exists(self.directorio):
+            os.makedirs(self.directorio)
+        self.df.to_pickle(self._data_path)
+        with open(self._meta_path, "w") as f:
+            json.dump(self.meta, f)
+
+    def load(self, refresh: bool = True) -> pd.DataFrame:
+        """
+        Returns the DataFrame of the source.
+
+        Parameters
+        ----------
+        refresh : bool, optional
+            If False and there is a cached DataFrame, it is returned without
+            reading the source. If True (the default) the source is read, and
+            the cached DataFrame is returned (the same object) when the data
+            did not change.
+        """
+        cached = self._load_disk()
+        if cached and not refresh:
+            return self.df
+
+        meta = dict(self.meta) if cached else {}
+        with metricas.stage("descarga"):
+            data = self.fuente.read(meta)
+            if data is None and not cached:
+                # the source answered "not modified" but there is no cached data
+                data = self.fuente.read({})
+        if data is None:
+            return self.df
+
+        sha1 = hashlib.sha1(data).hexdigest()
+        if cached and sha1 == self.meta.get("sha1"):
+            self.meta = dict(meta, sha1=sha1)
+            self._save_disk()
+            return self.df
+
+        self.df = self.parse(io.BytesIO(data), self.fuente.formato)
+        self.meta = dict(meta, sha1=sha1, version=self.version)
+        self._save_disk()
+        return self.df
+
+
+class ServidorLocal:
+    """
+    Local HTTP server that serves a file at any path, as a stand-in for the
+    Google Sheets export when working offline. It sends an ETag with the SHA-1
+    of the file and answers 304 to a matching If-None-Match.
+
+    Use it as a context manager:
+
+    >> with ServidorLocal("unifilar.csv") as servidor:
+    >>     df = get_data(servidor.url)
+    """
+
+    def __init__(self, path: str, host: str = "127.0.0.1", port: int = 0):
+        self.path = path
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    def _handler(self):
+        servidor = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    with open(servidor.path, "rb") as f:
+                        data = f.read()
+                except OSError as e:
+                    self.send_error(404, str(e))
+                    return
+                etag = f'"{hashlib.sha1(data).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/export?format=csv"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
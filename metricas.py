@@ -0,0 +1,305 @@
+import cProfile
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Metricas of the current run, None when the instrumentation is off
+_actual = None
+
+
+class Metricas:
+    """
+    Records the wall time, and optionally the peak of allocated memory, of
+    each stage of the pipeline (download, parse_data, create_tree, add_plot,
+    savefig...), the time of each figure and the exceptions that were
+    printed and skipped.
+
+    The stages can run in several threads at once (like the sources read by
+    get_data_multiple): each thread has its own stack of stages and its own
+    profile. tracemalloc measures the whole process, so the memory is only
+    measured for the stages of the main thread, and includes what the other
+    threads allocate meanwhile.
+
+    Parameters
+    ----------
+    memoria : bool, optional
+        If True, the memory is also traced with tracemalloc, which makes the
+        traced code much slower. The default is False.
+    perfil : str, optional
+        Name of a stage to run under cProfile.
+    lentas : int, optional
+        Number of slowest figures listed in the summary.
+    """
+
+    def __init__(self, memoria: bool = False, perfil: str = None, lentas: int = 10):
+        self.memoria = memoria
+        self.perfil = perfil
+        self.lentas = lentas
+        self.inicio = datetime.now().isoformat(timespec="seconds")
+        self.etapas = {}
+        self.items = []
+        self.errores = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # the profile of each thread
+        self._profiles = []
+        # statistics of the profiled stage sent by the worker processes
+        self._perfiles = []
+        if memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str, item: str = None):
+        """
+        Measures the code inside the with block as the stage `name`. If item is
+        given, the measure is also listed by item (one entry per figure). The
+        stages can be nested, an item records the time of the stages inside it.
+        """
+        local = self._thread()
+        stack = local.stack
+        memoria = self.memoria and threading.current_thread() is threading.main_thread()
+        frame = {"peak": 0, "detalle": {}, "item": item}
+        if memoria:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            frame["base"] = current
+        stack.append(frame)
+        profile = local.profile is not None and name == self.perfil
+        if profile:
+            local.profile.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profile:
+                local.profile.disable()
+            stack.pop()
+            peak = None
+            if memoria:
+                frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+                peak = (frame["peak"] - frame["base"]) / 2**20
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], frame["peak"])
+            self._add_stage(name, seconds, peak)
+            for parent in reversed(stack):
+                if parent["item"] is not None:
+                    parent["detalle"][name] = parent["detalle"].get(name, 0) + seconds
+                    break
+            if item is not None:
+                with self._lock:
+                    self.items.append(dict(frame["detalle"], etapa=name, nombre=item,
+                                           segundos=seconds, pico_MB=peak))
+
+    def _thread(self) -> threading.local:
+        """
+        Returns the stack of stages and the profile of the current thread.
+        """
+        local = self._local
+        if not hasattr(local, "stack"):
+            local.stack = []
+            local.profile = cProfile.Profile() if self.perfil else None
+            if local.profile is not None:
+                with self._lock:
+                    self._profiles.append(local.profile)
+        return local
+
+    def _add_stage(self, name: str, seconds: float, peak: float, calls: int = 1):
+        with self._lock:
+            etapa = self.etapas.setdefault(name, {"llamadas": 0, "segundos": 0.0,
+                                                  "pico_MB": None})
+            etapa["llamadas"] += calls
+            etapa["segundos"] += seconds
+            if peak is not None:
+                etapa["pico_MB"] = (peak if etapa["pico_MB"] is None
+                                    else max(etapa["pico_MB"], peak))
+
+    def add_error(self, stage: str, name: str, error):
+        """
+        Records an exception that was printed and skipped.
+        """
+        with self._lock:
+            self.errores.append({"etapa": stage, "nombre": name, "error": str(error)})
+
+    def export(self) -> dict:
+        """
+        Returns the stages, items and errors recorded since the last export and
+        clears them, to send the measures of a worker process to the main one.
+        With a profiled stage, the cProfile statistics are sent too.
+        """
+        with self._lock:
+            data = {"etapas": self.etapas, "items": self.items, "errores": self.errores}
+            self.etapas, self.items, self.errores = {}, [], []
+            if self.perfil:
+                data["perfil"] = self._profile_stats()
+                for profile in self._profiles:
+                    profile.clear()
+        return data
+
+    def merge(self, data: dict):
+        """
+        Adds the measures exported by a worker process.
+        """
+        for name, etapa in data["etapas"].items():
+            self._add_stage(name, etapa["segundos"], etapa["pico_MB"], etapa["llamadas"])
+        with self._lock:
+            self.items.extend(data["items"])
+            self.errores.extend(data["errores"])
+            if data.get("perfil"):
+                self._perfiles.append(data["perfil"])
+
+    def _profile_stats(self) -> dict:
+        """
+        Returns the cProfile statistics of all the threads of this process.
+        """
+        stats = {}
+        for profile in self._profiles:
+            profile.create_stats()
+            stats = _add_stats(stats, profile.stats)
+        return stats
+
+    def _stats(self) -> pstats.Stats:
+        """
+        Returns the statistics of the profiled stage, of this process and of
+        the worker processes.
+        """
+        stats = pstats.Stats()
+        for perfil in [self._profile_stats()] + self._perfiles:
+            process = pstats.Stats()
+            process.stats = perfil
+            process.get_top_level_stats()
+            stats.add(process)
+        return stats
+
+    def summary(self) -> dict:
+        """
+        Returns the summary of the run as a dictionary that can be saved as
+        JSON. The times of the stages run by several worker processes, and
+        their profile, are the sum of the ones of each process.
+        """
+        slowest = sorted(self.items, key=lambda item: item["segundos"], reverse=True)
+        por_etapa = {}
+        for error in self.errores:
+            por_etapa[error["etapa"]] = por_etapa.get(error["etapa"], 0) + 1
+        summary = {
+            "inicio": self.inicio,
+            "segundos": time.perf_counter() - self._start,
+            "memoria": self.memoria,
+            "etapas": self.etapas,
+            "figuras": sum(1 for item in self.items if item["etapa"] == "figura"),
+            "mas_lentas": slowest[:self.lentas],
+            "errores": {"total": len(self.errores), "por_etapa": por_etapa,
+                        "detalle": self.errores},
+        }
+        if self.perfil:
+            stats = self._stats()
+            functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+            summary["perfil"] = {
+                "etapa": self.perfil,
+                "funciones": [{"funcion": f"{path}:{line}({function})",
+                               "llamadas": calls, "segundos_propios": own,
+                               "segundos_acumulados": cumulative}
+                              for (path, line, function), (_, calls, own, cumulative, _)
+                              in functions[:30]],
+            }
+        return summary
+
+    def save(self, path: str):
+        """
+        Saves the summary as JSON. With a profiled stage, the full cProfile
+        statistics are saved next to it, with the extension .prof.
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+        if self.perfil:
+            self._stats().dump_stats(f"{os.path.splitext(path)[0]}.{self.perfil}.prof")
+
+    def close(self):
+        if self.memoria and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def _add_stats(a: dict, b: dict) -> dict:
+    """
+    Adds two dictionaries of cProfile statistics, like pstats.Stats.add.
+    """
+    total = pstats.Stats()
+    for stats in (a, b):
+        process = pstats.Stats()
+        process.stats = stats
+        process.get_top_level_stats()
+        total.add(process)
+    return total.stats
+
+
+def start(memoria: bool = False, perfil: str = None) -> Metricas:
+    """
+    Turns the instrumentation on for the rest of the run.
+    """
+    global _actual
+    _actual = Metricas(memoria=memoria, perfil=perfil)
+    return _actual
+
+
+def stop() -> Metricas:
+    """
+    Turns the instrumentation off and returns the Metricas of the run.
+    """
+    global _actual
+    metricas, _actual = _actual, None
+    if metricas is not None:
+        metricas.close()
+    return metricas
+
+
+def current() -> Metricas:
+    """
+    Returns the Metricas of the run, None when the instrumentation is off.
+    """
+    return _actual
+
+
+@contextmanager
+def stage(name: str, item: str = None):
+    """
+    Measures the with block as a stage of the current Metricas, does nothing
+    when the instrumentation is off.
+    """
+    if _actual is None:
+        yield
+    else:
+        with _actual.stage(name, item):
+            yield
+
+
+def record_error(stage: str, name: str, error):
+    """
+    Records an exception that was printed and skipped, if the instrumentation
+    is on.
+    """
+    if _actual is not None:
+        _actual.add_error(stage, name, error)
+
+
+def timed(name: str):
+    """
+    Decorator that measures each call of the function as the stage `name`.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _actual is None:
+                return function(*args, **kwargs)
+            with _actual.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,314 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+
+import numpy as np
+import pandas as pd
+import metricas
+from clases import Conductor, Proteccion, _m_curve_points, trip_times, trip_times_log
+from selectividad import _upstream
+
+# Settings allowed for the M curve breakers: I_r, I_sd and I_i are multiples
+# of I_t, t_r and t_sd are seconds. I_sd = 0 is the short delay turned off.
+AJUSTES = {
+    "I_r": np.round(np.arange(0.4, 1.0001, 0.05), 2),
+    "t_r": np.array([1, 2, 4, 8, 12, 16, 20, 24], dtype=float),
+    "I_sd": np.array([0, 1.5, 2, 2.5, 3, 4, 5, 6, 8, 10]),
+    "t_sd": np.array([0.1, 0.2, 0.3, 0.4]),
+    "I_i": np.array([2, 3, 4, 6, 8, 10, 12, 15], dtype=float),
+}
+_PARAMETERS = ("I_r", "t_r", "I_sd", "t_sd", "I_i")
+# Columns of get_data with the settings of the Termica
+_COLUMNS = {"I_r": "term_I_r", "t_r": "term_t_r", "I_sd": "term_I_sd", "t_sd": "term_t_sd",
+            "I_i": "term_I_i"}
+
+
+def candidate_settings(ajustes: dict = None) -> np.ndarray:
+    """
+    Returns the valid combinations of the allowed settings, one row per
+    combination with the columns I_r, t_r, I_sd, t_sd and I_i. The pickups
+    must increase (I_r < I_sd < I_i) and, without short delay, t_sd is not
+    used, so those combinations are only listed once.
+    """
+    ajustes = dict(AJUSTES, **(ajustes or {}))
+    grid = np.array(list(itertools.product(*(ajustes[name] for name in _PARAMETERS))),
+                    dtype=float)
+    valid = _ordered(grid) & ((grid[:, 2] != 0) | (grid[:, 3] == ajustes["t_sd"][0]))
+    return grid[valid]
+
+
+def _ordered(settings: np.ndarray) -> np.ndarray:
+    """
+    True for the rows of settings (columns I_r, t_r, I_sd, t_sd and I_i)
+    whose pickups increase, I_r < I_sd < I_i (or I_r < I_i without short
+    delay), and whose short delay is below the long delay (t_sd < t_r).
+    """
+    I_r, t_r, I_sd, t_sd, I_i = np.asarray(settings, dtype=float).T
+    return np.where(I_sd == 0, I_r < I_i, (I_r < I_sd) & (I_sd < I_i) & (t_sd < t_r))
+
+
+def _curve_points(settings: np.ndarray, I_t: float, t_i: float) -> tuple:
+    """
+    Returns the points of the M curves of many settings in log10, in the
+    order of Curva, as the arrays X, Y of trip_times_log. They are the same
+    points as Termica.curve (see clases._m_curve_points).
+    """
+    I, t = _m_curve_points(I_t, *settings.T, t_i)
+    return np.log10(I), np.log10(t)
+
+
+def _violations(T: np.ndarray, task: dict, margen: float) -> np.ndarray:
+    """
+    Number of currents of the grid where the breaker is not selective with
+    the protections upstream and downstream of it, or does not protect its
+    conductor. T has one row per candidate.
+    """
+    I = task["corrientes"]
+    T = np.minimum(T, task["T_fusible"])
+    checked = np.isfinite(T) & (I <= task["I_max"])
+    with np.errstate(invalid='ignore'):
+        upstream = checked & (task["T_arriba"] - T < margen)
+        downstream = T - task["T_abajo"] < margen
+    unprotected = np.isfinite(task["T_conductor"]) & (I <= task["I_max"]) & (T > task["T_conductor"])
+    return (upstream | downstream | unprotected).sum(axis=1)
+
+
+def _evaluate(task: dict, settings: np.ndarray, margen: float, chunk: int) -> np.ndarray:
+    """
+    Returns the number of problems of each row of settings, in batches of
+    chunk. A long delay pickup below the load current counts as a problem
+    in all the currents.
+    """
+    violations = np.empty(len(settings), dtype=np.int64)
+    for start in range(0, len(settings), chunk):
+        rows = slice(start, start + chunk)
+        X, Y = _curve_points(settings[rows], task["I_t"], task["t_i"])
+        violations[rows] = _violations(trip_times_log(X, Y, task["corrientes"]), task, margen)
+    violations[settings[:, 0] * task["I_t"] < task["I_n"]] += len(task["corrientes"])
+    return violations
+
+
+# Candidate settings of the worker processes, sent once when they start
+_worker_candidates = None
+
+
+def _init_worker(candidates: np.ndarray):
+    global _worker_candidates
+    _worker_candidates = candidates
+
+
+def _optimize_breaker_worker(task: dict, margen: float, chunk: int) -> np.ndarray:
+    return _optimize_breaker(task, _worker_candidates, margen, chunk)
+
+
+def _optimize_breaker(task: dict, candidates: np.ndarray, margen: float, chunk: int) -> np.ndarray:
+    """
+    Evaluates all the candidate settings of one breaker and returns the best
+    one: the one with less currents without selectivity or protection of the
+    conductor and, among them, the closest to the current settings. The
+    current settings are kept only if they are ordered (see _ordered).
+    """
+    actual = task["ajustes"]
+    settings = np.vstack([actual, candidates]) if _ordered(actual[None])[0] else candidates
+    violations = _evaluate(task, settings, margen, chunk)
+
+    # distance to the current settings, in log scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.abs(np.log(settings / actual))
+    off = (settings[:, 2] == 0) | (actual[2] == 0)
+    change[:, 2] = np.where(off, (settings[:, 2] != actual[2]).astype(float), change[:, 2])
+    change[:, 3] = np.where(off, 0, change[:, 3])
+    distance = np.nan_to_num(change, nan=1, posinf=1).sum(axis=1)
+    return settings[np.lexsort((distance, violations))[0]]
+
+
+def _downstream(proteccion: Proteccion) -> list:
+    """
+    Protections fed by the one given, the first ones below it in each path.
+    """
+    found = []
+    stack = list(proteccion.get_children() or [])
+    while stack:
+        nodo = stack.pop()
+        if nodo is None:
+            continue
+        if isinstance(nodo, Proteccion):
+            found.append(nodo)
+        else:
+            stack.extend(nodo.get_children() or [])
+    return found
+
+
+def _times(proteccion: Proteccion, termicas: dict, I: np.ndarray) -> np.ndarray:
+    """
+    Trip times of a Proteccion, with the new settings of its Termica if it
+    was already optimized.
+    """
+    T = np.full(len(I), np.inf)
+    termica = termicas.get(id(proteccion), proteccion.termica)
+    for device in (proteccion.fusible, termica):
+        if device is not None:
+            T = np.minimum(T, trip_times([device.curve()], I)[0])
+    return T
+
+
+def _I_max(proteccion: Proteccion) -> float:
+    I_cc = proteccion.termica.I_cc if proteccion.termica is not None else np.nan
+    return I_cc if I_cc > 0 else np.inf
+
+
+def _task(name: str, proteccion: Proteccion, termicas: dict, I: np.ndarray) -> dict:
+    """
+    Data needed to evaluate the settings of a breaker: the trip times of the
+    devices around it with their latest settings, sent to a worker process
+    instead of the tree.
+    """
+    termica = termicas[id(proteccion)]
+    upstream = _upstream(proteccion)
+    # the slowest protection downstream at each current that it checks
+    T_down = np.full(len(I), -np.inf)
+    for child in _downstream(proteccion):
+        T = _times(child, termicas, I)
+        checked = np.isfinite(T) & (I <= _I_max(child))
+        T_down = np.where(checked, np.maximum(T_down, T), T_down)
+    cable = proteccion.child
+    return {
+        "nombre": name, "corrientes": I, "I_t": termica.I_t, "t_i": termica.t_i,
+        "I_max": _I_max(proteccion),
+        "ajustes": np.array([getattr(termica, p) for p in _PARAMETERS], dtype=float),
+        "T_fusible": (trip_times([proteccion.fusible.curve()], I)[0]
+                      if proteccion.fusible is not None else np.inf),
+        "T_arriba": _times(upstream, termicas, I) if upstream is not None else np.inf,
+        "T_abajo": T_down,
+        "T_conductor": (trip_times([cable.curve()], I)[0]
+                        if isinstance(cable, Conductor) else np.inf),
+        "I_n": cable.I_n if isinstance(cable, Conductor) and cable.I_n > 0 else 0,
+    }
+
+
+@metricas.timed("optimize_settings")
+def optimize_settings(df: pd.DataFrame, items: dict, ajustes: dict = None,
+                      corrientes: np.ndarray = None, margen: float = 0.1,
+                      workers: int = 1, pasadas: int = 4, chunk: int = 4096) -> pd.DataFrame:
+    """
+    Proposes settings for the adjustable breakers (Termica with curve M) that
+    make them selective with the protections upstream and downstream of them,
+    with the same checks as analyze_selectivity, while they still protect
+    their conductor and do not trip with its load current.
+
+    The breakers are grouped by depth. The ones of the same depth are
+    independent, their settings are searched at the same time in the worker
+    processes, and each breaker is compared with the latest settings of the
+    ones upstream and downstream of it. For each breaker all the candidate
+    settings are evaluated in vectorized batches. The passes alternate from
+    the loads to the network and back, until no setting changes.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame of the items, as returned by get_data.
+    items : dict
+        Dictionary with the items of the tree built from df.
+    ajustes : dict, optional
+        Allowed values of each setting, replacing the ones of AJUSTES.
+    corrientes : np.ndarray, optional
+        Grid of currents (A). By default 241 points between 1 A and 1 MA.
+    margen : float, optional
+        Minimum time (s) between the trip of a protection and the trip of the
+        protection upstream of it. The default is 0.1 s.
+    workers : int, optional
+        Number of processes. With 1 (the default) the breakers are optimized
+        in the current process.
+    pasadas : int, optional
+        Maximum number of passes over all the breakers.
+    chunk : int, optional
+        Number of candidate settings evaluated at once, to bound the memory.
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of df with the new settings in the columns term_I_r,
+        term_t_r, term_I_sd, term_t_sd and term_I_i. df.attrs["ajustes"]
+        is a list of records, one per breaker, with its previous and new
+        settings, the number of currents of the grid with a problem before
+        (violaciones_antes) and after (violaciones), and if it has none
+        (factible). A breaker keeps its settings if no candidate has less
+        problems, unless they are not ordered (I_r < I_sd < I_i and
+        t_sd < t_r): those are flagged with ajustes_validos False and always
+        replaced, and their violaciones_antes are only indicative.
+    """
+    if corrientes is None:
+        corrientes = np.logspace(0, 6, 241)
+    corrientes = np.asarray(corrientes, dtype=float)
+    candidates = candidate_settings(ajustes)
+
+    adjustable = df[(df["term_curva"] == "M") & df["term_nombre"].notna()]
+    breakers = []
+    for name in adjustable["nombre"]:
+        proteccion = items[name]
+        while not isinstance(proteccion, Proteccion):
+            proteccion = proteccion.parent
+        depth = 0
+        upstream = _upstream(proteccion)
+        while upstream is not None:
+            depth += 1
+            upstream = _upstream(upstream)
+        breakers.append((depth, name, proteccion))
+    breakers.sort(key=lambda breaker: breaker[0])
+    levels = [[(name, proteccion) for _, name, proteccion in level]
+              for _, level in itertools.groupby(breakers, key=lambda breaker: breaker[0])]
+
+    termicas = {id(proteccion): proteccion.termica for _, _, proteccion in breakers}
+
+    def evaluate() -> list:
+        return [int(_evaluate(task, task["ajustes"][None], margen, chunk)[0])
+                for task in (_task(name, proteccion, termicas, corrientes)
+                             for _, name, proteccion in breakers)]
+
+    before = evaluate()
+    pool = (ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                initargs=(candidates,)) if workers > 1 and breakers else None)
+    try:
+        for pasada in range(pasadas):
+            changed = False
+            # the first pass goes from the loads to the network
+            for level in (levels[::-1] if pasada % 2 == 0 else levels):
+                tasks = [_task(name, proteccion, termicas, corrientes)
+                         for name, proteccion in level]
+                if pool is None:
+                    best = [_optimize_breaker(task, candidates, margen, chunk) for task in tasks]
+                else:
+                    best = pool.map(_optimize_breaker_worker, tasks,
+                                    itertools.repeat(margen), itertools.repeat(chunk))
+                for (name, proteccion), task, settings in zip(level, tasks, best):
+                    if not np.array_equal(settings, task["ajustes"]):
+                        changed = True
+                        termicas[id(proteccion)] = replace(
+                            termicas[id(proteccion)], **dict(zip(_PARAMETERS, settings.tolist())))
+            if not changed:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    after = evaluate()
+
+    optimized = df.copy()
+    names = [name for _, name, _ in breakers]
+    rows = pd.Index(optimized["nombre"]).get_indexer(names)
+    report = {"nombre": names}
+    for parameter in _PARAMETERS:
+        values = [getattr(termicas[id(proteccion)], parameter) for _, _, proteccion in breakers]
+        report[f"{parameter}_anterior"] = [getattr(proteccion.termica, parameter)
+                                           for _, _, proteccion in breakers]
+        report[parameter] = values
+        column = _COLUMNS[parameter]
+        optimized[column] = optimized[column].astype(float)
+        optimized.iloc[rows, optimized.columns.get_loc(column)] = values
+    report = pd.DataFrame(report)
+    report["ajustes_validos"] = _ordered(
+        report[[f"{parameter}_anterior" for parameter in _PARAMETERS]].to_numpy(dtype=float))
+    report["violaciones_antes"] = before
+    report["violaciones"] = after
+    report["factible"] = report["violaciones"] == 0
+    optimized.attrs = dict(df.attrs, ajustes=report.to_dict("records"))
+    return optimized
@@ -0,0 +1,141 @@
+import fnmatch
+import re
+from bisect import bisect_left
+
+import numpy as np
+import pandas as pd
+from clases import flatten_tree, tree_root
+
+_WILDCARDS = re.compile(r"[*?\[]")
+
+
+class Indice:
+    """
+    Indexes of the items of the tree to select them without going over all of
+    them: the names sorted (for prefixes and the literal start of a glob), the
+    sector and emergency columns of the DataFrame, and the range of each
+    item in the preorder of the tree (for the subtrees).
+
+    The subtree index is built the first time it is used.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree, as returned by create_tree.
+    df : pd.DataFrame, optional
+        DataFrame of the items, needed to select by sector or emergency.
+    """
+
+    def __init__(self, items: dict, df: pd.DataFrame = None):
+        self.items = items
+        self.names = list(items)
+        keys = [str(name) for name in self.names]
+        self._order = np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+        self._sorted = [keys[i] for i in self._order]
+        self._position = {name: i for i, name in enumerate(self.names)}
+        self._columns = {}
+        if df is not None:
+            rows = [self._position.get(name, -1) for name in df["nombre"]]
+            for column in ("sector", "es_emergencia"):
+                groups = {}
+                for row, value in zip(rows, df[column]):
+                    if row != -1:
+                        groups.setdefault(value, []).append(row)
+                self._columns[column] = {value: np.array(positions, dtype=np.int64)
+                                         for value, positions in groups.items()}
+        self._start = None
+        self._end = None
+        self._preorder = None
+        self._by_preorder = None
+
+    def _prefix(self, prefix: str) -> np.ndarray:
+        lo = bisect_left(self._sorted, prefix)
+        hi = bisect_left(self._sorted, prefix + "\U0010ffff", lo)
+        return self._order[lo:hi]
+
+    def _glob(self, pattern: str) -> np.ndarray:
+        # only the names that start with the literal part of the pattern
+        literal = _WILDCARDS.split(pattern, 1)[0]
+        candidates = self._prefix(literal)
+        match = re.compile(fnmatch.translate(pattern)).match
+        return np.array([i for i in candidates if match(str(self.names[i]))], dtype=np.int64)
+
+    def _regex(self, pattern: str) -> np.ndarray:
+        search = re.compile(pattern).search
+        return np.array([i for i, name in enumerate(self.names) if search(str(name))],
+                        dtype=np.int64)
+
+    def _column(self, column: str, value) -> np.ndarray:
+        if column not in self._columns:
+            raise ValueError(f"Para seleccionar por {column} hace falta el DataFrame")
+        return self._columns[column].get(value, np.empty(0, dtype=np.int64))
+
+    def _build_subtrees(self):
+        nodes, parents = flatten_tree(tree_root(self.items))
+        # size of the subtree of each node, children after their parent
+        size = np.ones(len(nodes), dtype=np.int64)
+        for i in range(len(nodes) - 1, 0, -1):
+            size[parents[i]] += size[i]
+        position = {id(nodo): i for i, nodo in enumerate(nodes)}
+        self._start = np.array([position[id(nodo)] for nodo in self.items.values()],
+                               dtype=np.int64)
+        self._end = self._start + size[self._start]
+        self._by_preorder = np.argsort(self._start)
+        self._preorder = self._start[self._by_preorder]
+
+    def _subtree(self, name) -> np.ndarray:
+        if name not in self._position:
+            raise ValueError(f"La barra/carga {name} no existe")
+        if self._start is None:
+            self._build_subtrees()
+        i = self._position[name]
+        lo, hi = np.searchsorted(self._preorder, [self._start[i], self._end[i]])
+        return self._by_preorder[lo:hi]
+
+    def select(self, prefix: str = None, glob: str = None, regex: str = None,
+               sector=None, es_emergencia: bool = None, subtree=None) -> list:
+        """
+        Returns the names of the items that meet all the given conditions, in
+        the order of the items dictionary. Without conditions it returns all
+        the items.
+
+        Parameters
+        ----------
+        prefix : str, optional
+            Names that start with prefix.
+        glob : str, optional
+            Names that match a shell pattern, like "TS5.*" or "CAS?.1[0-9]".
+        regex : str, optional
+            Names where the regular expression is found.
+        sector : optional
+            Items of the sector.
+        es_emergencia : bool, optional
+            Emergency (True) or normal (False) items.
+        subtree : str, optional
+            The bus or load with this name and everything fed from it.
+
+        Raises
+        ------
+        ValueError
+            If the subtree item does not exist, or the index has no DataFrame
+            and sector or es_emergencia are given.
+        """
+        selections = []
+        if prefix is not None:
+            selections.append(self._prefix(str(prefix)))
+        if glob is not None:
+            selections.append(self._glob(glob))
+        if regex is not None:
+            selections.append(self._regex(regex))
+        if sector is not None:
+            selections.append(self._column("sector", sector))
+        if es_emergencia is not None:
+            selections.append(self._column("es_emergencia", bool(es_emergencia)))
+        if subtree is not None:
+            selections.append(self._subtree(subtree))
+        if not selections:
+            return list(self.names)
+        selected = selections[0]
+        for selection in selections[1:]:
+            selected = np.intersect1d(selected, selection)
+        return [self.names[i] for i in np.unique(selected)]
@@ -0,0 +1,295 @@
+from dataclasses import fields
+
+import numpy as np
+import pandas as pd
+import metricas
+from clases import Barra, Conductor, Proteccion, log_points, trip_times, trip_times_log
+
+
+# Fields of the curve of each type of device, see _device_key
+_KEY_FIELDS = {Conductor: ("S", "K", "I_adm")}
+
+
+def _device_key(device) -> tuple:
+    """
+    Key of the curve of a Fusible, Termica or Conductor: its type and all its
+    parameters except the name.
+    """
+    cls = type(device)
+    names = _KEY_FIELDS.get(cls)
+    if names is None:
+        names = _KEY_FIELDS[cls] = tuple(f.name for f in fields(device) if f.name != "name")
+    return (cls.__name__,) + tuple(getattr(device, name) for name in names)
+
+
+class _CurveTable:
+    """
+    Collects the curves of many devices, evaluating each distinct curve only
+    once.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.curvas = []
+
+    def add(self, device) -> int:
+        if device is None:
+            return -1
+        key = _device_key(device)
+        if key not in self.rows:
+            self.rows[key] = len(self.curvas)
+            self.curvas.append(device.curve())
+        return self.rows[key]
+
+    def evaluate(self, I: np.ndarray) -> np.ndarray:
+        """
+        Returns a matrix with one row per distinct curve, plus a last row of
+        np.inf for the missing devices (row -1).
+        """
+        return np.vstack([trip_times(self.curvas, I), np.full((1, len(I)), np.inf)])
+
+
+def _upstream(proteccion: Proteccion) -> Proteccion:
+    nodo = proteccion.parent
+    while nodo is not None and not isinstance(nodo, Proteccion):
+        nodo = nodo.parent
+    return nodo
+
+
+def _current_range(mask: np.ndarray, I: np.ndarray) -> tuple:
+    """
+    Returns the lowest and highest current where each row of the mask is True,
+    NaN if it is never True.
+    """
+    I = np.broadcast_to(I, mask.shape)
+    return (np.where(mask, I, np.inf).min(axis=1),
+            np.where(mask, I, -np.inf).max(axis=1))
+
+
+@metricas.timed("analyze_selectivity")
+def analyze_selectivity(items: dict, corrientes: np.ndarray = None,
+                        margen: float = 0.1, chunk: int = 4096) -> pd.DataFrame:
+    """
+    Checks the coordination of every protection of the tree without plotting.
+
+    Each Proteccion is compared with the first Proteccion upstream of it, and
+    with the Conductor it feeds, over a shared grid of currents.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree, as returned by create_tree.
+    corrientes : np.ndarray, optional
+        Grid of currents (A). By default 241 points between 1 A and 1 MA.
+    margen : float, optional
+        Minimum time (s) between the trip of a protection and the trip of the
+        protection upstream of it. The default is 0.1 s.
+    chunk : int, optional
+        Number of protections compared at once, to bound the memory used.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per item, with the columns:
+
+        - nombre, aguas_arriba: the item and the bus upstream of it.
+        - I_limite_selectividad, I_solape_max: range of currents where the
+          upstream protection trips before or together with the protection
+          of the item.
+        - I_sin_margen_min: lowest current where the upstream protection
+          trips less than `margen` seconds after the protection of the item.
+        - margen_min: smallest time difference between both protections.
+        - selectivo: True if there is no overlap nor missing margin.
+        - I_desprotegido_min, I_desprotegido_max: range of currents where
+          the conductor supports less time than its protection needs.
+        - conductor_protegido: True if that range is empty.
+
+    Notes
+    -----
+    The currents above the breaking capacity (I_cc) of the Termica of the item
+    are not checked.
+    """
+    if corrientes is None:
+        corrientes = np.logspace(0, 6, 241)
+    corrientes = np.asarray(corrientes, dtype=float)
+
+    names = list(items)
+    devices = _CurveTable()
+    conductores = _CurveTable()
+    fusible, termica, fusible_up, termica_up, cable = [], [], [], [], []
+    aguas_arriba, I_max = [], []
+    for name in names:
+        proteccion = items[name]
+        while not isinstance(proteccion, Proteccion):
+            proteccion = proteccion.parent
+        upstream = _upstream(proteccion)
+        fusible.append(devices.add(proteccion.fusible))
+        termica.append(devices.add(proteccion.termica))
+        fusible_up.append(devices.add(upstream.fusible if upstream else None))
+        termica_up.append(devices.add(upstream.termica if upstream else None))
+        cable.append(conductores.add(proteccion.child)
+                     if isinstance(proteccion.child, Conductor) else -1)
+        aguas_arriba.append(
+            proteccion.parent.name if isinstance(proteccion.parent, Barra) else None)
+        I_cc = proteccion.termica.I_cc if proteccion.termica is not None else np.nan
+        I_max.append(I_cc if I_cc > 0 else np.inf)
+
+    T_devices = devices.evaluate(corrientes)
+    T_conductores = conductores.evaluate(corrientes)
+    fusible, termica, fusible_up, termica_up, cable = map(
+        np.array, (fusible, termica, fusible_up, termica_up, cable))
+    I_max = np.array(I_max, dtype=float)
+
+    columns = {key: np.empty(len(names)) for key in (
+        "I_limite_selectividad", "I_solape_max", "I_sin_margen_min", "margen_min",
+        "I_desprotegido_min", "I_desprotegido_max")}
+    for start in range(0, len(names), chunk):
+        rows = slice(start, start + chunk)
+        T = np.minimum(T_devices[fusible[rows]], T_devices[termica[rows]])
+        T_up = np.minimum(T_devices[fusible_up[rows]], T_devices[termica_up[rows]])
+        T_cable = T_conductores[cable[rows]]
+        checked = np.isfinite(T) & (corrientes <= I_max[rows, None])
+
+        overlap = checked & (T_up <= T)
+        with np.errstate(invalid='ignore'):
+            tight = checked & ~overlap & (T_up - T < margen)
+            diff = np.where(checked & np.isfinite(T_up), T_up - T, np.inf)
+        unprotected = (np.isfinite(T_cable) & (corrientes <= I_max[rows, None])
+                       & (T > T_cable))
+
+        (columns["I_limite_selectividad"][rows],
+         columns["I_solape_max"][rows]) = _current_range(overlap, corrientes)
+        columns["I_sin_margen_min"][rows] = _current_range(tight, corrientes)[0]
+        columns["margen_min"][rows] = diff.min(axis=1)
+        (columns["I_desprotegido_min"][rows],
+         columns["I_desprotegido_max"][rows]) = _current_range(unprotected, corrientes)
+
+    report = pd.DataFrame({"nombre": names, "aguas_arriba": aguas_arriba})
+    for key, values in columns.items():
+        report[key] = np.where(np.isfinite(values), values, np.nan)
+    report["selectivo"] = (report["I_limite_selectividad"].isna()
+                           & report["I_sin_margen_min"].isna())
+    report["conductor_protegido"] = report["I_desprotegido_min"].isna()
+    return report[["nombre", "aguas_arriba", "selectivo", "I_limite_selectividad",
+                   "I_solape_max", "I_sin_margen_min", "margen_min",
+                   "conductor_protegido", "I_desprotegido_min", "I_desprotegido_max"]]
+
+
+def _given(currents, name, default: float) -> float:
+    """
+    Current of an item: currents if it is a number, currents[name] if it is
+    a dict or Series that has it, and default otherwise. 0 is unknown.
+    """
+    if currents is not None and np.ndim(currents) == 0 and not isinstance(currents, dict):
+        value = currents
+    elif currents is not None and name in currents:
+        value = currents[name]
+    else:
+        value = default
+    return value if value is not None and value > 0 else np.nan
+
+
+@metricas.timed("analyze_let_through")
+def analyze_let_through(items: dict, I_cc=None, I_cc_min=None) -> pd.DataFrame:
+    """
+    Checks that the protection of every item clears a short circuit before
+    its conductor is damaged: the let-through energy I²t, with t the trip
+    time of the protection at the fault current, must not exceed the K²S²
+    that the conductor supports. Nothing is plotted.
+
+    Each item is checked at the maximum current at the start of its conductor
+    (the I_cc of the bus that feeds it) and at the minimum current at its end
+    (the I_cc_min of the bus or load), computed by cortocircuito.short_circuit,
+    unless other currents are given. The trip times of all the items are
+    evaluated at once, one row per item.
+
+    Parameters
+    ----------
+    items : dict
+        Dictionary with the items of the tree, as returned by create_tree.
+    I_cc, I_cc_min : float or dict, optional
+        Maximum and minimum short-circuit currents (A), the same for all the
+        items or by name, instead of the ones of the tree.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per item, with the columns:
+
+        - nombre, conductor: the item and its conductor.
+        - K2S2: the energy that the conductor supports (A²s).
+        - I_cc, t_corte, I2t: the maximum current, the trip time of the
+          protection and the energy that lets through.
+        - I_cc_min, t_corte_min, I2t_min: the same at the minimum current.
+        - margen: the smallest 1 - I²t / K²S² of both currents, negative if
+          the conductor is not protected.
+        - verificado: True if at least one of the currents is known.
+        - cumple: True if it is verified and the margin is not negative.
+
+    Notes
+    -----
+    A Termica does not clear the currents above its breaking capacity (I_cc).
+    The time of a Fusible is the one of its melting curve, which below 0.1 s
+    underestimates the energy that it lets through.
+    """
+    names = list(items)
+    devices = _CurveTable()
+    fusible, termica, capacity, cables, K2S2, I_max, I_min = [], [], [], [], [], [], []
+    for name in names:
+        leaf = items[name]
+        proteccion = leaf
+        while not isinstance(proteccion, Proteccion):
+            proteccion = proteccion.parent
+        fusible.append(devices.add(proteccion.fusible))
+        termica.append(devices.add(proteccion.termica))
+        breaking = proteccion.termica.I_cc if proteccion.termica is not None else np.nan
+        capacity.append(breaking if breaking > 0 else np.inf)
+        cable = proteccion.child if isinstance(proteccion.child, Conductor) else None
+        cables.append(cable.name if cable is not None else None)
+        K2S2.append((cable.K * cable.S) ** 2 if cable is not None and cable.S and cable.K
+                    else np.nan)
+        # the items fed from the network have the current of their own bus
+        bus = proteccion.parent
+        I_max.append(_given(I_cc, name, bus.I_cc if isinstance(bus, Barra)
+                            else getattr(leaf, "I_cc", 0)))
+        I_min.append(_given(I_cc_min, name, getattr(leaf, "I_cc_min", 0)))
+
+    I = np.column_stack([np.array(I_max, dtype=float), np.array(I_min, dtype=float)])
+    X, Y = log_points(devices.curvas)
+
+    def times(rows: np.ndarray) -> np.ndarray:
+        T = np.full(I.shape, np.inf)
+        present = rows >= 0
+        if present.any():
+            T[present] = trip_times_log(X[rows[present]], Y[rows[present]], I[present])
+        return T
+
+    T_termica = times(np.array(termica, dtype=np.int64))
+    T_termica[I > np.array(capacity, dtype=float)[:, None]] = np.inf
+    T = np.fmin(times(np.array(fusible, dtype=np.int64)), T_termica)
+    T[np.isnan(I)] = np.nan
+    K2S2 = np.array(K2S2, dtype=float)
+    with np.errstate(invalid='ignore'):
+        energy = I ** 2 * T
+        margins = 1 - energy / K2S2[:, None]
+    known = ~np.isnan(margins)
+    margen = np.where(known, margins, np.inf).min(axis=1)
+
+    report = pd.DataFrame({"nombre": names, "conductor": cables, "K2S2": K2S2,
+                           "I_cc": I[:, 0], "t_corte": T[:, 0], "I2t": energy[:, 0],
+                           "I_cc_min": I[:, 1], "t_corte_min": T[:, 1], "I2t_min": energy[:, 1]})
+    report["verificado"] = known.any(axis=1)
+    report["margen"] = np.where(report["verificado"], margen, np.nan)
+    report["cumple"] = report["verificado"] & (report["margen"] >= 0)
+    return report[["nombre", "conductor", "K2S2", "I_cc", "t_corte", "I2t", "I_cc_min",
+                   "t_corte_min", "I2t_min", "margen", "verificado", "cumple"]]
+
+
+def save_report(report: pd.DataFrame, path: str):
+    """
+    Saves the report as JSON if the path ends with .json, as CSV otherwise.
+    """
+    if path.lower().endswith(".json"):
+        report.to_json(path, orient="records", indent=2, force_ascii=False)
+    else:
+        report.to_csv(path, index=False)
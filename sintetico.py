@@ -0,0 +1,144 @@
+import csv
+import io
+import random
+
+from clases import CATALOGO_FUSIBLES
+
+# Headers of columns B:AB, in the order get_data expects them
+_HEADERS = ['Sector', 'Carga', 'Emergencia', 'Nombre', 'I_n', 'Conductor',
+            '', 'S', 'I_adm', 'K', '', 'Termica', 'I_t', 'I_cc',
+            'I_r', 't_r', 'I_sd', 't_sd', 'I_i',
+            'Curva', 'Guardamotor', 'I_t', 'I_cc', 'Curva', 'Fusible', 'I_f',
+            'Alimentador']
+_UNITS = ['', '', 'SI/NO', '', 'A', '', '', 'mm²', 'A', '', '', '', 'A', 'A',
+          'xI_t', 's', 'xI_t', 's', 'xI_t', '', '', 'A', 'A', '', '', 'A', '']
+
+# Cross-section (mm²) and admissible current (A) of the cables
+_CABLES = [(1.5, 15), (2.5, 21), (4, 28), (6, 36), (10, 50), (16, 66), (25, 84),
+           (35, 104), (50, 125), (70, 160), (95, 194), (120, 225), (150, 260),
+           (185, 297), (240, 350), (300, 404)]
+_BREAKERS = [6, 10, 16, 20, 25, 32, 40, 50, 63, 80, 100, 125, 160, 200, 250,
+             320, 400, 500, 630, 800, 1000, 1250]
+
+MEZCLA = {"C": 0.45, "M": 0.15, "guardamotor": 0.2, "fusible": 0.2}
+
+
+def _number(value: float) -> str:
+    """
+    Writes a number with decimal comma, as the sheet exports them.
+    """
+    return f"{value:g}".replace('.', ',')
+
+
+def _next(values: list, minimum: float) -> float:
+    for value in values:
+        if value >= minimum:
+            return value
+    return values[-1]
+
+
+def _row(rnd: random.Random, nombre: str, I_n: float, es_carga: bool,
+         alimentador: str, mezcla: dict) -> list:
+    """
+    Creates the 27 columns of one bus or load, with a protection of the kind
+    drawn from mezcla and a cable that carries its rated current.
+    """
+    kind = rnd.choices(list(mezcla), weights=list(mezcla.values()))[0]
+    if kind == "M" and I_n < 100:
+        kind = "C"
+    I_t = _next(_BREAKERS, I_n)
+    S, I_adm = next(((S, I) for S, I in _CABLES if I >= I_t), _CABLES[-1])
+    row = [rnd.choice("ABCD"), "x" if es_carga else "",
+           "SI" if rnd.random() < 0.1 else "NO", nombre, _number(I_n),
+           f"Cable {nombre}", "", _number(S), _number(I_adm), "115", ""]
+    termica = [""] * 8
+    guardamotor = [""] * 4
+    fusible = ["", ""]
+    if kind == "C":
+        termica = [f"Q {nombre}", _number(I_t), "10000", "", "", "", "", "", "C"]
+    elif kind == "M":
+        termica = [f"Q {nombre}", _number(I_t), "25000", "0,8", "12", "4", "0,1", "10", "M"]
+    elif kind == "guardamotor":
+        guardamotor = [f"GM {nombre}", _number(I_n), "50000", "C"]
+    else:
+        calibres = CATALOGO_FUSIBLES.familias[("generico", "gG")][0]
+        fusible = [f"F {nombre}", _number(_next(list(calibres), I_n))]
+    termica = termica + [""] * (9 - len(termica))
+    return row + termica + guardamotor + fusible + [alimentador]
+
+
+def generate_sheet(n_barras: int = 100, fan_out: int = 5, profundidad: int = 6,
+                   mezcla: dict = None, seed: int = 0) -> str:
+    """
+    Generates a synthetic single-line diagram in the CSV layout of the Google
+    Sheets export read by get_data.
+
+    Parameters
+    ----------
+    n_barras : int, optional
+        Number of buses. Every bus feeds between 1 and 2*fan_out - 1 loads,
+        fan_out on average.
+    fan_out : int, optional
+        Average number of loads per bus.
+    profundidad : int, optional
+        Maximum number of buses from the network to a load.
+    mezcla : dict, optional
+        Weights of the protection of each row: "C" and "M" breakers, motor
+        protectors ("guardamotor") and fuses ("fusible"). M breakers are only
+        used from 100 A. By default MEZCLA.
+    seed : int, optional
+        Seed of the random generator, the same seed gives the same sheet.
+
+    Returns
+    -------
+    str
+        The CSV text, with the header in row 3 and the data from row 5.
+    """
+    rnd = random.Random(seed)
+    mezcla = MEZCLA if mezcla is None else mezcla
+
+    # buses: a random tree, the first buses are fed from the network
+    roots = max(1, n_barras // 500)
+    parents = [None] * n_barras
+    depth = [0] * n_barras
+    eligible = list(range(min(roots, n_barras)))
+    for i in range(roots, n_barras):
+        parent = rnd.choice(eligible)
+        parents[i] = parent
+        depth[i] = depth[parent] + 1
+        if depth[i] < profundidad - 1:
+            eligible.append(i)
+
+    loads = [[rnd.uniform(1, 60) for _ in range(rnd.randint(1, max(1, 2 * fan_out - 1)))]
+             for _ in range(n_barras)]
+    # the current of a bus is the sum of the currents it feeds
+    current = [sum(cargas) for cargas in loads]
+    for i in range(n_barras - 1, roots - 1, -1):
+        current[parents[i]] += current[i]
+
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["Unifilar sintetico"])
+    writer.writerow([])
+    writer.writerow([""] + _HEADERS)
+    writer.writerow([""] + _UNITS)
+    index = 1
+    for i in range(n_barras):
+        barra = f"TS{i}"
+        alimentador = "" if parents[i] is None else f"TS{parents[i]}"
+        writer.writerow([index] + _row(rnd, barra, round(current[i], 1), False,
+                                       alimentador, mezcla))
+        index += 1
+        for j, I_n in enumerate(loads[i]):
+            writer.writerow([index] + _row(rnd, f"{barra}.{j}", round(I_n, 1), True,
+                                           barra, mezcla))
+            index += 1
+    return output.getvalue()
+
+
+def write_sheet(path: str, **kwargs):
+    """
+    Writes a synthetic sheet (see generate_sheet) to a CSV file.
+    """
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write(generate_sheet(**kwargs))
@@ -0,0 +1,311 @@
+import html
+import http.server
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import curvas
+from clases import Barra, Carga
+
+_CONTENT_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class CacheBytes:
+    """
+    LRU cache of rendered images, bounded by the number of images and by
+    their total size in bytes. It is safe to use from several threads.
+    """
+
+    def __init__(self, maxsize: int = 512, max_bytes: int = 128 * 2**20):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> bytes:
+        with self._lock:
+            data = self._data.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return data
+
+    def put(self, key, data: bytes):
+        with self._lock:
+            if key in self._data:
+                self.bytes -= len(self._data.pop(key))
+            self._data[key] = data
+            self.bytes += len(data)
+            while self._data and (len(self._data) > self.maxsize or self.bytes > self.max_bytes):
+                self.bytes -= len(self._data.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"imagenes": len(self._data), "bytes": self.bytes, "aciertos": self.hits,
+                    "fallos": self.misses, "max_imagenes": self.maxsize,
+                    "max_bytes": self.max_bytes}
+
+
+class VisorCurvas:
+    """
+    Local HTTP service to browse the curves of the single-line diagram:
+
+    - /curve/<name>.png and /curve/<name>.svg: the plot of a bus or load.
+    - /tree.json: the tree of buses and loads, with the url of each curve.
+    - /stats.json: the state of the cache of images.
+    - /refresh (POST): reads the sources again.
+    - /: an index with links to every curve.
+
+    The plots are rendered on demand by a pool of worker processes, and kept
+    in an LRU cache (CacheBytes) by the hash of their protection path (see
+    Nodo.plot_hash), so a repeated view does not render again. When the data
+    is refreshed the tree is patched (see curvas.patch_tree) and the workers
+    are started again with the new data, but the cache is kept: only the
+    plots whose protection path changed have a new hash and are rendered
+    again.
+
+    Use it as a context manager, or call serve_forever:
+
+    >> with VisorCurvas(["unifilar.csv"]) as visor:
+    >>     print(visor.url)
+
+    Parameters
+    ----------
+    urls : list
+        Sources of the data, as accepted by curvas.get_data_multiple.
+    host, port : optional
+        Address of the service. With port 0 a free port is used.
+    workers : int, optional
+        Number of processes that render the plots.
+    cache_size : int, optional
+        Maximum number of images kept in the cache.
+    cache_bytes : int, optional
+        Maximum size of the images kept in the cache.
+    refresh : bool, optional
+        If True, the sources are read when the service starts. By default the
+        data saved in the cache folder is used, as in the menu.
+    """
+
+    def __init__(self, urls: list, host: str = "127.0.0.1", port: int = 8000,
+                 workers: int = 1, cache_size: int = 512, cache_bytes: int = 128 * 2**20,
+                 refresh: bool = False):
+        self.urls = urls
+        self.workers = workers
+        self.cache = CacheBytes(cache_size, cache_bytes)
+        self._lock = threading.Lock()
+        # only one refresh at a time, from the read of the sources to the swap
+        self._refresh_lock = threading.Lock()
+        self._pending = {}
+        self.df = None
+        self.items = None
+        self.cambios = None
+        self._hashes = {}
+        self._pool = None
+        self._load(curvas.get_data_multiple(urls, refresh=refresh))
+        self._server = http.server.ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    def _load(self, df, items: dict = None):
+        """
+        Replaces the data, the tree and the workers. If the tree is not given
+        it is built and the cache is cleared.
+        """
+        clear = items is None
+        if clear:
+            items = curvas.get_tree(df)
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=curvas._init_worker,
+                                   initargs=(df,))
+        with self._lock:
+            old_pool = self._pool
+            self.df, self.items, self._pool = df, items, pool
+            self._hashes = {}
+            self._pending = {}
+            if clear:
+                self.cache.clear()
+        if old_pool is not None:
+            old_pool.shutdown(wait=False, cancel_futures=True)
+
+    def refresh(self) -> bool:
+        """
+        Reads the sources again. Returns True if the data changed, and the
+        changes of the tree are left in cambios (see curvas.patch_tree).
+        """
+        with self._refresh_lock:
+            df = curvas.get_data_multiple(self.urls)
+            if df is self.df:
+                return False
+            # the nodes are changed in place, no hash is computed meanwhile
+            with self._lock:
+                items, self.cambios = curvas.patch_tree(self.items, self.df, df)
+            self._load(df, items)
+            return True
+
+    def _key(self, name: str, formato: str) -> tuple:
+        with self._lock:
+            plot_hash = self._hashes.get(name)
+            if plot_hash is None:
+                plot_hash = curvas._plot_hash(self.items, name)
+                self._hashes[name] = plot_hash
+        return plot_hash, formato
+
+    def curve(self, name: str, formato: str = "png") -> bytes:
+        """
+        Returns the image of the item, from the cache or rendered by a worker.
+        Concurrent requests of the same image wait for the same render.
+
+        Raises
+        ------
+        KeyError
+            If the item does not exist.
+        """
+        if name not in self.items:
+            raise KeyError(name)
+        key = self._key(name, formato)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pool.submit(curvas._render_plot_worker, name, formato)
+                self._pending[key] = future
+        try:
+            data = future.result()
+        finally:
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+        self.cache.put(key, data)
+        return data
+
+    def tree(self) -> dict:
+        """
+        Returns the tree of buses and loads, each one with its name, type,
+        url of its curve and children.
+        """
+        with self._lock:
+            return self._tree()
+
+    def _tree(self) -> dict:
+        root = curvas.tree_root(self.items)
+        tree = {"nombre": root.name, "tipo": type(root).__name__, "hijos": []}
+        # preorder, each node with the entry of the closest bus above it
+        stack = [(child, tree) for child in reversed(root.get_children() or [])]
+        while stack:
+            nodo, entry = stack.pop()
+            if nodo is None:
+                continue
+            if isinstance(nodo, (Barra, Carga)):
+                child_entry = {"nombre": nodo.name, "tipo": type(nodo).__name__,
+                               "url": _curve_url(nodo.name), "hijos": []}
+                entry["hijos"].append(child_entry)
+                entry = child_entry
+            stack.extend((child, entry) for child in reversed(nodo.get_children() or []))
+        return tree
+
+    def _index(self) -> str:
+        links = "\n".join(f'<li><a href="{_curve_url(name)}">{html.escape(str(name))}</a></li>'
+                          for name in self.items)
+        return (f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>Curvas</title>"
+                f"</head><body><h1>Curvas</h1><ul>{links}</ul></body></html>")
+
+    def _handler(self):
+        visor = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def _send(self, code: int, content_type: str, data: bytes):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_json(self, value, code: int = 200):
+                self._send(code, "application/json; charset=utf-8",
+                           json.dumps(value, ensure_ascii=False).encode())
+
+            def do_GET(self):
+                path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+                if path == "/":
+                    self._send(200, "text/html; charset=utf-8", visor._index().encode())
+                elif path == "/tree.json":
+                    self._send_json(visor.tree())
+                elif path == "/stats.json":
+                    self._send_json(visor.cache.stats())
+                elif path.startswith("/curve/") and "." in path:
+                    name, formato = path[len("/curve/"):].rsplit(".", 1)
+                    if formato not in _CONTENT_TYPES:
+                        self._send_json({"error": f"Formato no soportado: {formato}"}, 404)
+                        return
+                    try:
+                        data = visor.curve(name, formato)
+                    except KeyError:
+                        self._send_json({"error": f"La barra/carga {name} no existe"}, 404)
+                        return
+                    except Exception as e:
+                        self._send_json({"error": str(e)}, 500)
+                        return
+                    self._send(200, _CONTENT_TYPES[formato], data)
+                else:
+                    self._send_json({"error": "No encontrado"}, 404)
+
+            def do_POST(self):
+                if urllib.parse.urlsplit(self.path).path != "/refresh":
+                    self._send_json({"error": "No encontrado"}, 404)
+                    return
+                try:
+                    changed = visor.refresh()
+                except Exception as e:
+                    self._send_json({"error": str(e)}, 500)
+                    return
+                self._send_json({"cambiaron": changed,
+                                 "subarboles": visor.cambios["subarboles"] if changed else []})
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def serve_forever(self):
+        try:
+            self._server.serve_forever()
+        finally:
+            self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _curve_url(name: str, formato: str = "png") -> str:
+    return f"/curve/{urllib.parse.quote(str(name))}.{formato}"